@@ -5,7 +5,9 @@ from pushmaster import tweaks
 
 from google.appengine.ext import webapp
 from google.appengine.ext.webapp.util import run_wsgi_app
+from pushmaster import cache
 from pushmaster import config
+from pushmaster import context
 from pushmaster.view import api
 from pushmaster.view import home
 from pushmaster.view import request
@@ -20,20 +22,36 @@ class LoggingWSGIApplication(webapp.WSGIApplication):
     def __call__(self, environ, start_response):
         request = self.REQUEST_CLASS(environ)
         self.log.debug('incoming %s for %s' % (environ['REQUEST_METHOD'], request.uri))
-        return super(LoggingWSGIApplication, self).__call__(environ, start_response)
+        context.begin()
+        cache.begin_request()
+        statuses = []
+        def recording_start_response(status, *args):
+            statuses.append(status)
+            return start_response(status, *args)
+        try:
+            return super(LoggingWSGIApplication, self).__call__(environ, recording_start_response)
+        finally:
+            # revalidations are most requests; their stats can wait for another one
+            cache.end_request(flush=not statuses or not statuses[0].startswith('304'))
+            context.end()
 
 application = LoggingWSGIApplication([
         ('/requests', request.Requests),
         ('/pushes', push.Pushes),
         ('/api/search', api.Search),
+        ('/api/cachestats', api.CacheStats),
         ('/api/pushes', api.Pushes),
         ('/request/([^/]+)', request.EditRequest),
         ('/push/([^/]+)/json', push.PushJSON),
+        ('/push/([^/]+)/wait', push.PushWait),
         ('/push/(.+)', push.EditPush),
+        ('/api/push/([^/]+)/changes', api.PushChanges),
         ('/api/push/(.+)', api.EditPush),
         ('/api/request/(.+)', api.Request),
         ('/api/requests', api.Requests),
         ('/lastweek/(\d+)', report.LastWeek),
+        ('/report/(\d{8})/(\d{8})/json', report.DateRangeJSON),
+        ('/report/(\d{8})/(\d{8})', report.DateRange),
         ('/lastweek/?', report.LastWeek),
         ('/flush', home.FlushMemcache),
         ('/user/(.+)', home.UserHome),
@@ -0,0 +1,418 @@
+import cPickle as pickle
+import logging
+import time
+
+from google.appengine.api import memcache
+
+from pushmaster import context
+
+log = logging.getLogger('pushmaster.cache')
+
+#
+# counters
+#
+
+# Every namespace has two counters in memcache. Its generation is baked into
+# its keys, so bumping it invalidates the whole namespace. Its stamp changes
+# whenever anything in it changes, including entries updated in place, and
+# tells instances when their local copies are stale.
+GENERATION_KEY = 'generation-%s'
+STAMP_KEY = 'stamp-%s'
+
+# namespaces whose counters are read in one batch at the start of a request
+warm_namespaces = set()
+
+# counter values seen by the current request, None outside of one
+request_counters = None
+
+def counter_seed():
+    # a counter evicted from memcache restarts from the clock rather than from
+    # a value its old entries may still be cached under
+    return int(time.time())
+
+def read_counters(counter_keys):
+    values = {}
+    missing = []
+    for counter_key in counter_keys:
+        if request_counters is not None and counter_key in request_counters:
+            values[counter_key] = request_counters[counter_key]
+        else:
+            missing.append(counter_key)
+
+    if missing:
+        fetched = memcache.get_multi(missing)
+        for counter_key in missing:
+            if counter_key not in fetched:
+                memcache.add(counter_key, counter_seed())
+                fetched[counter_key] = memcache.get(counter_key) or counter_seed()
+            values[counter_key] = fetched[counter_key]
+        if request_counters is not None:
+            request_counters.update(fetched)
+
+    return values
+
+def namespace_counters(namespace):
+    generation_key, stamp_key = GENERATION_KEY % namespace, STAMP_KEY % namespace
+    values = read_counters([generation_key, stamp_key])
+    return values[generation_key], values[stamp_key]
+
+def bump_counter(counter_key):
+    context.forget()
+    value = memcache.incr(counter_key, initial_value=counter_seed())
+    if request_counters is not None:
+        if value is None:
+            request_counters.pop(counter_key, None)
+        else:
+            request_counters[counter_key] = value
+
+def generation(namespace):
+    return namespace_counters(namespace)[0]
+
+def stamp(namespace):
+    return namespace_counters(namespace)[1]
+
+def key(namespace, key):
+    """The memcache key for key in the current generation of namespace."""
+    return '%s-%d' % (key, generation(namespace))
+
+def keys(namespace, keys):
+    current = generation(namespace)
+    return ['%s-%d' % (key, current) for key in keys]
+
+def bust(*namespaces):
+    """Invalidate everything cached under namespaces.
+
+    Entries of older generations are never read again and expire on their own.
+    """
+    for namespace in namespaces:
+        bump_counter(GENERATION_KEY % namespace)
+        bump_counter(STAMP_KEY % namespace)
+
+def touch(namespace):
+    """Mark namespace as changed without invalidating its memcache entries."""
+    bump_counter(STAMP_KEY % namespace)
+
+def refresh(*namespaces):
+    """Re-read the counters of namespaces, replacing the request's snapshot.
+
+    For requests that wait on other instances' writes, like long polls.
+    """
+    counter_keys = []
+    for namespace in namespaces:
+        counter_keys.extend([GENERATION_KEY % namespace, STAMP_KEY % namespace])
+    if request_counters is not None:
+        for counter_key in counter_keys:
+            request_counters.pop(counter_key, None)
+    read_counters(counter_keys)
+
+def begin_request():
+    """Snapshot the counters of warm namespaces with one memcache round trip."""
+    global request_counters
+    request_counters = {}
+    counter_keys = []
+    for namespace in warm_namespaces:
+        counter_keys.extend([GENERATION_KEY % namespace, STAMP_KEY % namespace])
+    read_counters(counter_keys)
+
+def end_request(flush=True):
+    """Forget the request's counters and flush stats unless flush is False.
+
+    Stats left pending are flushed by a later request, at most
+    COUNTS_FLUSH_SECONDS later.
+    """
+    global request_counters
+    request_counters = None
+    if flush or time.time() - last_flush > COUNTS_FLUSH_SECONDS:
+        flush_counts()
+
+#
+# stats
+#
+
+STATS_KEY = 'cache-stats-%s'
+
+pending_counts = {}
+last_flush = 0
+COUNTS_FLUSH_SECONDS = 60
+
+def count(stat, delta=1):
+    if not delta:
+        return
+    pending_counts[stat] = pending_counts.get(stat, 0) + delta
+    if request_counters is None:
+        flush_counts()
+
+def flush_counts():
+    global last_flush
+    last_flush = time.time()
+    if pending_counts:
+        memcache.offset_multi(pending_counts, key_prefix=STATS_KEY % '', initial_value=0)
+        pending_counts.clear()
+
+def counts(stats):
+    values = memcache.get_multi(stats, key_prefix=STATS_KEY % '')
+    return dict((stat, values.get(stat, 0)) for stat in stats)
+
+def reset_counts(stats):
+    memcache.delete_multi(stats, key_prefix=STATS_KEY % '')
+
+TIERS = ('local', 'memcache')
+
+def hit_stats(names):
+    """Hits, misses and hit ratio for each name counted as name.hit and name.miss."""
+    stats = []
+    for name in names:
+        stats.extend([name + '.hit', name + '.miss'])
+    values = counts(stats)
+
+    ratios = {}
+    for name in names:
+        hits, misses = values[name + '.hit'], values[name + '.miss']
+        lookups = hits + misses
+        ratios[name] = {'hits': hits, 'misses': misses, 'hit_ratio': float(hits) / lookups if lookups else None}
+    return ratios
+
+def tier_stats():
+    return hit_stats(TIERS)
+
+#
+# instance-local tier
+#
+
+LOCAL_MAX_ENTRIES = 500
+LOCAL_SECONDS = 5 * 60
+
+class LocalCache(object):
+    """A size- and age-bounded LRU cache private to this instance.
+
+    Values are kept pickled so callers never share mutable objects, and each
+    one remembers the stamp of its namespace when it was stored.
+    """
+
+    def __init__(self, max_entries=LOCAL_MAX_ENTRIES, seconds=LOCAL_SECONDS):
+        self.max_entries = max_entries
+        self.seconds = seconds
+        self.entries = {}
+        self.tick = 0
+
+    def get(self, key, stamp):
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+
+        data, entry_stamp, expires, _ = entry
+        if entry_stamp != stamp or expires < time.time():
+            del self.entries[key]
+            return None
+
+        self.tick += 1
+        self.entries[key] = (data, entry_stamp, expires, self.tick)
+        return pickle.loads(data)
+
+    def set(self, key, value, stamp):
+        self.tick += 1
+        self.entries[key] = (pickle.dumps(value, pickle.HIGHEST_PROTOCOL), stamp, time.time() + self.seconds, self.tick)
+        if len(self.entries) > self.max_entries:
+            self.evict()
+
+    def evict(self):
+        # drop the least recently used tenth at once to keep inserts cheap
+        by_use = sorted(self.entries.iteritems(), key=lambda (key, entry): entry[3])
+        for key, _ in by_use[:len(by_use) - self.max_entries * 9 / 10]:
+            del self.entries[key]
+
+    def delete(self, key):
+        self.entries.pop(key, None)
+
+    def clear(self):
+        self.entries.clear()
+
+local = LocalCache()
+
+#
+# reads and writes
+#
+
+def get_multi(namespace, names):
+    """Read names from namespace, trying this instance before memcache."""
+    current_generation, current_stamp = namespace_counters(namespace)
+
+    values = {}
+    remote = {}
+    for name in names:
+        cache_key = '%s-%d' % (name, current_generation)
+        value = local.get(cache_key, current_stamp)
+        if value is None:
+            remote[cache_key] = name
+        else:
+            values[name] = value
+    count('local.hit', len(values))
+    count('local.miss', len(remote))
+
+    if remote:
+        fetched = memcache.get_multi(remote.keys())
+        for cache_key, value in fetched.iteritems():
+            local.set(cache_key, value, current_stamp)
+            values[remote[cache_key]] = value
+        count('memcache.hit', len(fetched))
+        count('memcache.miss', len(remote) - len(fetched))
+
+    return values
+
+def get(namespace, name):
+    return get_multi(namespace, [name]).get(name)
+
+def store_multi(namespace, mapping, expires=0, add=False):
+    current_generation, current_stamp = namespace_counters(namespace)
+    keyed = dict(('%s-%d' % (name, current_generation), value) for name, value in mapping.iteritems())
+    if add:
+        memcache.add_multi(keyed, expires)
+    else:
+        memcache.set_multi(keyed, expires)
+    for cache_key, value in keyed.iteritems():
+        local.set(cache_key, value, current_stamp)
+
+def store(namespace, name, value, expires=0):
+    store_multi(namespace, {name: value}, expires)
+
+def add(namespace, name, value, expires=0):
+    store_multi(namespace, {name: value}, expires, add=True)
+
+def delete(namespace, name, lock_seconds=0):
+    """Drop name from namespace.
+
+    With lock_seconds, adds of name fail for that long, so a reader that
+    loaded the old value before the delete cannot put it back.
+    """
+    cache_key = key(namespace, name)
+    local.delete(cache_key)
+    memcache.delete(cache_key, lock_seconds)
+    touch(namespace)
+
+def fresh_stamp(namespace):
+    """The stamp of namespace as memcache has it now, not as the request first saw it."""
+    refresh(namespace)
+    return stamp(namespace)
+
+def load(namespace, name, compute, expires=0):
+    """Compute name on a miss and add it, unless namespace changed meanwhile.
+
+    update writes nothing when it finds no entry, so a value computed across
+    a concurrent update would miss that change for as long as it is cached.
+    Returns the value and whether it was kept.
+    """
+    before = fresh_stamp(namespace)
+    value = compute()
+    add(namespace, name, value, expires)
+    if fresh_stamp(namespace) != before:
+        # the entry may predate a write; the next reader computes it again
+        cache_key = key(namespace, name)
+        local.delete(cache_key)
+        memcache.delete(cache_key)
+        return value, False
+    return value, True
+
+CAS_RETRIES = 10
+
+def update(namespace, name, fn, expires=0, stale=False):
+    """Replace the value cached under name with fn(value) using compare-and-set.
+
+    Nothing is written on a cold miss; the next reader fills the cache from the
+    datastore, and readers filling it concurrently with load drop their value. If every retry loses a race the entry is dropped instead, so a
+    concurrent writer's change can never be lost. Either way the namespace is
+    touched so other instances drop their local copies. Pass stale=True for
+    names read with get_or_compute's stale shadow: it is replaced along with
+    the entry, or dropped when the entry could not be updated, so it never
+    lacks this change.
+    """
+    cache_key = key(namespace, name)
+    local.delete(cache_key)
+    # touch before reading too, so a reader filling this name concurrently
+    # (see load) notices the change even when there is nothing to update yet
+    touch(namespace)
+    try:
+        client = memcache.Client()
+        for _ in xrange(CAS_RETRIES):
+            value = client.gets(cache_key)
+            if value is None:
+                break
+            value = fn(value)
+            if client.cas(cache_key, value, expires):
+                if stale:
+                    memcache.set(STALE_KEY % name, value, STALE_SECONDS)
+                return True
+        else:
+            log.warning('cas update of %s failed %d times, dropping it', cache_key, CAS_RETRIES)
+            memcache.delete(cache_key)
+
+        if stale:
+            memcache.delete(STALE_KEY % name)
+        return False
+    finally:
+        touch(namespace)
+
+#
+# leases
+#
+
+LEASE_SECONDS = 10
+LEASE_WAIT_SECONDS = 1.0
+LEASE_POLL_SECONDS = 0.05
+STALE_SECONDS = 7 * 24 * 60 * 60
+STALE_KEY = 'stale-%s'
+
+LEASE_STATS = ('recompute', 'stale', 'wait', 'wait_ms', 'wait_timeout')
+
+def lease_stats(name):
+    return ['%s.%s' % (name, stat) for stat in LEASE_STATS]
+
+def fill(namespace, name, compute, expires, stat=None, stale=True):
+    # an add, kept only if no write-through ran during compute
+    value, kept = load(namespace, name, compute, expires)
+    if stale and kept:
+        memcache.set(STALE_KEY % name, value, STALE_SECONDS)
+    count((stat or name) + '.recompute')
+    return value
+
+def get_or_compute(namespace, name, compute, expires=0, stat=None, stale=True):
+    """Read name from namespace, letting only one caller at a time compute it.
+
+    On a miss the caller that wins the lease (a memcache add) runs compute.
+    Everyone else gets the previous value from a longer-lived shadow key or,
+    failing that, waits briefly for the winner before computing it themselves.
+    Pass stale=False when readers must never see an old value, and stat to
+    count lease outcomes under a name shared by many keys. compute must not
+    return None.
+    """
+    stat = stat or name
+
+    value = get(namespace, name)
+    if value is not None:
+        return value
+
+    cache_key = key(namespace, name)
+    lease_key = 'lease-' + cache_key
+    if memcache.add(lease_key, 1, LEASE_SECONDS):
+        try:
+            return fill(namespace, name, compute, expires, stat, stale)
+        finally:
+            memcache.delete(lease_key)
+
+    if stale:
+        value = memcache.get(STALE_KEY % name)
+        if value is not None:
+            count(stat + '.stale')
+            return value
+
+    started = time.time()
+    while time.time() - started < LEASE_WAIT_SECONDS:
+        time.sleep(LEASE_POLL_SECONDS)
+        value = memcache.get(cache_key)
+        if value is not None:
+            count(stat + '.wait')
+            count(stat + '.wait_ms', int((time.time() - started) * 1000))
+            return value
+
+    log.info('lease on %s not released after %.1fs, computing it anyway', cache_key, LEASE_WAIT_SECONDS)
+    count(stat + '.wait_timeout')
+    return fill(namespace, name, compute, expires, stat, stale)
@@ -0,0 +1,63 @@
+import datetime
+import threading
+
+from google.appengine.ext import db
+
+from pushmaster import timezone
+
+class RequestContext(object):
+    """State that lives for exactly one HTTP request."""
+
+    def __init__(self):
+        self.memo = {}
+        self.now = datetime.datetime.now(timezone.utc)
+
+local = threading.local()
+
+def begin():
+    local.context = RequestContext()
+
+def end():
+    local.context = None
+
+def current():
+    return getattr(local, 'context', None)
+
+def now():
+    """The current time in UTC, frozen for the rest of the request."""
+    context = current()
+    if context is None:
+        return datetime.datetime.now(timezone.utc)
+    return context.now
+
+def forget():
+    """Drop memoized results, e.g. after a write has made them stale."""
+    context = current()
+    if context is not None:
+        context.memo.clear()
+
+def memo_key(arg):
+    if isinstance(arg, db.Model):
+        return arg.key()
+    return arg
+
+def memoize(fn):
+    """Remember fn's results by argument for the rest of the request.
+
+    Entities are compared by key. Outside of a request fn is always called.
+    """
+    def memoized(*args, **kw):
+        context = current()
+        if context is None:
+            return fn(*args, **kw)
+
+        key = (fn.__module__, fn.__name__, tuple(map(memo_key, args)), tuple(sorted((name, memo_key(value)) for name, value in kw.iteritems())))
+        try:
+            return context.memo[key]
+        except KeyError:
+            value = context.memo[key] = fn(*args, **kw)
+            return value
+
+    memoized.__name__ = fn.__name__
+    memoized.__doc__ = fn.__doc__
+    return memoized
@@ -2,6 +2,7 @@ import logging
 import datetime
 
 from google.appengine.api import users
+from google.appengine.ext import db
 from google.appengine.runtime.apiproxy_errors import OverQuotaError
 
 import config
@@ -13,6 +14,10 @@ __author__ = 'Jeremy Latt <jlatt@yelp.com>'
 
 log = logging.getLogger('pushmaster.logic')
 
+def set_message_html(request):
+    request.message_html = util.linkify(request.message)
+    request.message_html_version = util.LINKIFY_VERSION
+
 def create_request(subject, **kw):
     return set_request_properties(model.Request(), subject, **kw)
 
@@ -40,9 +45,10 @@ def set_request_properties(request, subject, message=None, push_plans=False, urg
     if message:
         assert len(message) > 0
         request.message = message
+    set_message_html(request)
 
     request.put()
-    query.bust_request_caches()
+    query.update_current_requests(request)
 
     send_request_mail(request)
 
@@ -64,9 +70,10 @@ def abandon_request(request):
     request.push = None
 
     request.put()
-    query.bust_request_caches()
+    query.update_current_requests(request)
     if push is not None:
-        push.bust_requests_cache()
+        query.update_push_requests(push, request)
+        record_push_changes(push, request_change('request_removed', request))
 
     return request
 
@@ -82,16 +89,17 @@ def abandon_push(push):
     assert push.state in ('accepting', 'onstage')
 
     push.state = 'abandoned'
-    for request in query.push_requests(push):
+    requests = query.push_requests(push)
+    for request in requests:
         request.state = 'requested'
         request.push = None
         request.put()
 
     push.put()
     query.bust_push_caches()
-    query.bust_push_caches()
-    query.bust_request_caches()
-    push.bust_requests_cache()
+    query.update_current_requests(*requests)
+    query.update_push_requests(push, *requests)
+    record_push_changes(push, push_change('push_state', push), *[request_change('request_removed', request) for request in requests])
 
     return push
 
@@ -104,8 +112,9 @@ def accept_request(push, request):
     request.state = 'accepted'
 
     request.put()
-    query.bust_request_caches()
-    push.bust_requests_cache()
+    query.update_current_requests(request)
+    query.update_push_requests(push, request)
+    record_push_changes(push, request_change('request_added', request))
 
     util.send_im(
         to=request.owner.email(),
@@ -131,8 +140,9 @@ def withdraw_request(request):
     request.state = 'requested'
 
     request.put()
-    query.bust_request_caches()
-    push.bust_requests_cache()
+    query.update_current_requests(request)
+    query.update_push_requests(push, request)
+    record_push_changes(push, request_change('request_removed', request))
 
     util.send_mail(
         to=[push_owner_email, config.mail_to, config.mail_request],
@@ -147,12 +157,14 @@ def send_to_stage(push, stage):
 
     checkedin_requests = query.push_requests(push, state='checkedin')
     if checkedin_requests:
+        changes = []
         if push.state != 'onstage' or push.stage != stage:
             push.state = 'onstage'
             push.stage = stage
 
             push.put()
             query.bust_push_caches()
+            changes.append(push_change('push_state', push))
 
         for request in checkedin_requests:
             request.state = 'onstage'
@@ -174,8 +186,10 @@ def send_to_stage(push, stage):
                 stage=push.stage,
                 )
             request.put()
+            changes.append(request_change('request_state', request))
 
-        push.bust_requests_cache()
+        query.update_push_requests(push, *checkedin_requests)
+        record_push_changes(push, *changes)
 
     return push
 
@@ -188,7 +202,8 @@ def set_request_tested(request, bust_caches=True):
     request.put()
 
     if bust_caches:
-        push.bust_requests_cache()
+        query.update_push_requests(push, request)
+    record_push_changes(push, request_change('request_state', request))
 
     push_owner_email = push.owner.email()
 
@@ -217,7 +232,10 @@ def send_to_live(push):
 
     push.put()
     query.bust_push_caches()
-    push.bust_requests_cache()
+    query.update_push_requests(push, *requests)
+    record_push_changes(push, push_change('push_state', push), *[request_change('request_state', request) for request in requests])
+    util.queue_week_report(push.ltime)
+    record_live_push(push, requests)
 
     return push
 
@@ -229,7 +247,8 @@ def set_request_checkedin(request):
     request.state = 'checkedin'
 
     request.put()
-    push.bust_requests_cache()
+    query.update_push_requests(push, request)
+    record_push_changes(push, request_change('request_state', request))
 
     util.send_mail(
         to=[push.owner.email(), config.mail_to],
@@ -256,27 +275,33 @@ def take_ownership(object):
     object.put()
 
     if isinstance(object, model.Request):
-        query.bust_request_caches()
+        query.update_current_requests(object)
         push = object.push
         if push is not None:
-            object.push.bust_requests_cache()
+            query.update_push_requests(push, object)
+            record_push_changes(push, request_change('request_owner', object, owner=object.owner))
     elif isinstance(object, model.Push):
         query.bust_push_caches()
+        record_push_changes(object, push_change('push_owner', object, owner=object.owner))
 
     return object
 
 def force_live(push):
-    for request in query.push_requests(push):
+    requests = query.push_requests(push)
+    for request in requests:
         request.state = 'live'
 
         request.put()
-    push.bust_requests_cache()
+    query.update_push_requests(push, *requests)
 
     push.state = 'live'
     push.ltime = push.mtime
 
     push.put()
     query.bust_push_caches()
+    record_push_changes(push, push_change('push_state', push), *[request_change('request_state', request) for request in requests])
+    util.queue_week_report(push.ltime)
+    record_live_push(push, requests)
 
     return push
 
@@ -289,9 +314,10 @@ def reject_request(request, rejector, reason=None):
         request.reject_reason = reason
 
     request.put()
-    query.bust_request_caches()
+    query.update_current_requests(request)
     if push is not None:
-        push.bust_requests_cache()
+        query.update_push_requests(push, request)
+        record_push_changes(push, request_change('request_removed', request))
 
     util.send_im(
         to=request.owner.email(),
@@ -313,21 +339,123 @@ def reject_request(request, rejector, reason=None):
 
 
 def create_user_info(user):
-    user_info = model.UserInfo(user=user, full_name=user.nickname())
+    user_info = model.UserInfo.default_for(user)
 
     user_info.put()
 
     return user_info
 
 def user_info(user):
-    return query.info_for_user(user) or create_user_info(user)
+    return query.info_for_user(user) or model.UserInfo.default_for(user)
+
+def user_infos(users):
+    """Map each of users to its UserInfo. Users without one get an unsaved default."""
+    user_infos = query.infos_for_users(users)
+
+    for user in users:
+        if user is not None and user not in user_infos:
+            user_infos[user] = model.UserInfo.default_for(user)
+
+    return user_infos
 
 
 def unlive(push):
+    if push.state == 'live' and push.ltime:
+        remove_live_push(push)
     push.state = 'onstage'
     push.put()
-    for request in push.requests:
+    requests = list(push.requests)
+    for request in requests:
         request.state = 'tested'
         request.put()
-    push.bust_requests_cache()
+    query.update_push_requests(push, *requests)
     query.bust_push_caches()
+    record_push_changes(push, push_change('push_state', push), *[request_change('request_state', request) for request in requests])
+
+def request_change(kind, request, **kw):
+    return dict(kind=kind, request=str(request.key()), state=request.state, **kw)
+
+def push_change(kind, push, **kw):
+    return dict(kind=kind, state=push.state, stage=push.stage, **kw)
+
+def record_push_changes(push, *changes):
+    """Append changes, dicts of PushChange properties, to push's change log.
+
+    Sequence numbers come from the push's PushChangeLog in the same
+    transaction, so they are gapless and never reused. The log is a
+    convenience for pollers: if the transaction loses to concurrent writes
+    the changes are dropped and logged, never failing the caller's own write.
+    """
+    if not changes:
+        return
+
+    def txn():
+        change_log = model.PushChangeLog.get_by_key_name('log', parent=push)
+        if change_log is None:
+            change_log = model.PushChangeLog(key_name='log', parent=push)
+        entities = [change_log]
+        for change in changes:
+            change_log.seq += 1
+            entities.append(model.PushChange(parent=push, seq=change_log.seq, **change))
+        db.put(entities)
+    try:
+        db.run_in_transaction(txn)
+    except (db.TransactionFailedError, db.Timeout):
+        log.exception('dropped %d changes to the log of push %s', len(changes), push.key())
+
+    # pollers revalidate against the push version, so bump it after the log
+    push.touch_version()
+
+def push_totals(requests, dev_teams):
+    """Count a live push's requests by owner, team and state."""
+    totals = {'requests': len(requests), 'devs': {}, 'teams': {}, 'states': {}}
+    for request in requests:
+        nickname = request.owner.nickname()
+        totals['devs'][nickname] = totals['devs'].get(nickname, 0) + 1
+        for team in dev_teams.get(nickname, ()):
+            totals['teams'][team] = totals['teams'].get(team, 0) + 1
+        totals['states'][request.state] = totals['states'].get(request.state, 0) + 1
+    return totals
+
+def update_week_aggregate(datestr, push_totals_by_key, replace=False):
+    """Set (or, for None, remove) the totals of pushes in a week's aggregate."""
+    def txn():
+        aggregate = model.WeekAggregate.get_by_key_name(datestr)
+        if aggregate is None:
+            aggregate = model.WeekAggregate(key_name=datestr)
+        pushes = {} if replace else aggregate.get_pushes()
+        for push_key, totals in push_totals_by_key.iteritems():
+            if totals is None:
+                pushes.pop(push_key, None)
+            else:
+                pushes[push_key] = totals
+        aggregate.set_pushes(pushes)
+        aggregate.put()
+    db.run_in_transaction(txn)
+
+def record_live_push(push, requests):
+    totals = push_totals(requests, query.teams_by_dev())
+    update_live_push(push, totals)
+
+def remove_live_push(push):
+    update_live_push(push, None)
+
+def update_live_push(push, totals):
+    # the push has already changed state by now, so a lost aggregate update
+    # must not fail it; the week's report task recounts from the pushes
+    try:
+        update_week_aggregate(util.week_datestr(push.ltime), {str(push.key()): totals})
+    except (db.TransactionFailedError, db.Timeout):
+        log.exception('dropped the week aggregate update for push %s, recounting it', push.key())
+        util.queue_week_report(push.ltime)
+
+def rebuild_week_aggregate(datestr, from_date):
+    """Recount a week from its live pushes, e.g. for weeks before aggregates existed."""
+    pushes = query.pushes_for_the_week_of(from_date)
+    requests_by_push = {}
+    for request in query.requests_for_pushes(pushes):
+        requests_by_push.setdefault(str(model.Request.push.get_value_for_datastore(request)), []).append(request)
+
+    dev_teams = query.teams_by_dev()
+    totals = dict((str(push.key()), push_totals(requests_by_push.get(str(push.key()), []), dev_teams)) for push in pushes)
+    update_week_aggregate(datestr, totals, replace=True)
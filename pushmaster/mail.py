@@ -6,7 +6,7 @@ from google.appengine.api import users
 from google.appengine.api.datastore_errors import BadKeyError
 from google.appengine.ext.webapp.mail_handlers import InboundMailHandler 
 
-from pushmaster import config, logic, model, query, util
+from pushmaster import config, logic, query, util
 
 class PushMailHandler(InboundMailHandler):
     push_key_address_re = re.compile(r'push-(.+)')
@@ -28,7 +28,7 @@ class PushMailHandler(InboundMailHandler):
 
         try:
             push_key = match.group(1)
-            push = model.Push.get(push_key)
+            push = query.get_push(push_key)
             requester_emails = list(set([request.owner.email() for request in query.push_requests(push)]))
             kw = dict(sender=sender, to=requester_emails, subject=mail_message.subject, body=text_body, reply_to=sender)
             logging.info('sending push mail: %r', kw)
@@ -1,10 +1,10 @@
 import datetime
+import time
 
-from google.appengine.api import memcache
+from django.utils import simplejson as json
 from google.appengine.ext import db
 
-
-from pushmaster import urls
+from pushmaster import cache, urls
 
 
 __author__ = 'Jeremy Latt <jlatt@yelp.com>'
@@ -19,12 +19,27 @@ class ConfigModel(db.Model):
     git_branch_url = db.StringProperty()
 
 
+ENTITY_CACHE_NAMESPACE = 'entities'
+# how long after a put the entity cache refuses to be refilled with older reads
+ENTITY_LOCK_SECONDS = 10
+ROSTER_CACHE_NAMESPACE = 'roster'
+USER_INFO_CACHE_NAMESPACE = 'user-info'
+# rendered request items, which show their owner's full name
+FRAGMENT_CACHE_NAMESPACE = 'fragments'
+# when a push last changed, in seconds since the epoch, cached in its namespace
+PUSH_CHANGED_CACHE_KEY = 'changed'
+
 class TrackedModel(db.Model):
     cuser = db.UserProperty(auto_current_user_add=True)
     ctime = db.DateTimeProperty(auto_now_add=True)
     muser = db.UserProperty(auto_current_user=True)
     mtime = db.DateTimeProperty(auto_now=True)
 
+    def put(self):
+        key = super(TrackedModel, self).put()
+        cache.delete(ENTITY_CACHE_NAMESPACE, str(key), ENTITY_LOCK_SECONDS)
+        return key
+
 
 class Push(TrackedModel):
     all_states = ('accepting', 'onstage', 'live', 'abandoned')
@@ -38,11 +53,22 @@ class Push(TrackedModel):
     stage = db.StringProperty(choices=all_stages, default=default_stage)
 
     @property
-    def requests_cache_key(self):
+    def cache_namespace(self):
+        return 'push-%s' % self.key()
+
+    @property
+    def requests_cache_name(self):
         return 'push-requests-%s' % self.key()
 
-    def bust_requests_cache(self):
-        memcache.delete(self.requests_cache_key)
+    def touch_version(self):
+        # request list writes touch it too, which makes its stamp a version
+        cache.touch(self.cache_namespace)
+        cache.store(self.cache_namespace, PUSH_CHANGED_CACHE_KEY, int(time.time()))
+
+    def put(self):
+        key = super(Push, self).put()
+        self.touch_version()
+        return key
 
     @property
     def ptime(self):
@@ -84,6 +110,8 @@ class Request(TrackedModel):
     subject = db.StringProperty(default='')
     branch = db.StringProperty(default='')
     message = db.TextProperty(default='')
+    message_html = db.TextProperty(default='')
+    message_html_version = db.IntegerProperty(default=0)
     state = db.StringProperty(choices=all_states, default=default_state)
     reject_reason = db.TextProperty(default='')
     target_date = db.DateProperty()
@@ -130,16 +158,133 @@ class Request(TrackedModel):
                }
 
 
-class UserInfo(TrackedModel):
+class PushChange(db.Model):
+    """One entry in the change log of the push that is its parent."""
+
+    all_kinds = ('request_added', 'request_removed', 'request_state', 'request_owner', 'push_state', 'push_owner')
+    seq = db.IntegerProperty(required=True)
+    kind = db.StringProperty(choices=all_kinds, required=True)
+    request = db.StringProperty()
+    state = db.StringProperty()
+    stage = db.StringProperty()
+    owner = db.UserProperty()
+    cuser = db.UserProperty(auto_current_user_add=True)
+    ctime = db.DateTimeProperty(auto_now_add=True)
+
+    @property
+    def json(self):
+        data = {'seq': self.seq,
+                'kind': self.kind,
+                'ctime': self.ctime.strftime('%s'),
+                }
+        for name in ('request', 'state', 'stage'):
+            value = getattr(self, name)
+            if value is not None:
+                data[name] = value
+        if self.owner is not None:
+            data['owner'] = self.owner.email()
+        return data
+
+
+class PushChangeLog(db.Model):
+    """The last sequence number given out in a push's change log.
+
+    There is one per push, a child keyed 'log', so it shares an entity group
+    with the changes it numbers.
+    """
+
+    seq = db.IntegerProperty(default=0)
+
+
+class UserKeyedModel(TrackedModel):
+    """Base for entities keyed by the normalized email of their user."""
+
+    @staticmethod
+    def key_name_for(user):
+        return user.email().lower()
+
+    @classmethod
+    def get_by_user(cls, users):
+        """Fetch entities for a user, or a list of users, by key."""
+        if isinstance(users, (list, tuple)):
+            return cls.get_by_key_name([cls.key_name_for(user) for user in users])
+        return cls.get_by_key_name(cls.key_name_for(users))
+
+    @classmethod
+    def for_user(cls, user, **kw):
+        return cls(key_name=cls.key_name_for(user), user=user, **kw)
+
+
+class UserInfo(UserKeyedModel):
 
     full_name = db.StringProperty(default='')
 
     user = db.UserProperty()
 
+    @classmethod
+    def default_for(cls, user):
+        return cls.for_user(user, full_name=user.nickname())
+
+    @staticmethod
+    def cache_name_for(user):
+        return 'user-info-%s' % user.nickname()
+
+    def put(self):
+        key = super(UserInfo, self).put()
+        # drop the old copy first so the roster and fragments rebuild from this one
+        cache.delete(USER_INFO_CACHE_NAMESPACE, self.cache_name_for(self.user), ENTITY_LOCK_SECONDS)
+        # the roster and rendered fragments carry full names
+        cache.bust(ROSTER_CACHE_NAMESPACE, FRAGMENT_CACHE_NAMESPACE)
+        return key
 
-class ReportUser(TrackedModel):
+
+class ReportUser(UserKeyedModel):
 
     teams = db.StringListProperty(default=[])
     role = db.StringProperty(default='dev')
 
     user = db.UserProperty()
+
+    def put(self):
+        key = super(ReportUser, self).put()
+        cache.bust(ROSTER_CACHE_NAMESPACE)
+        return key
+
+    def delete(self):
+        super(ReportUser, self).delete()
+        cache.bust(ROSTER_CACHE_NAMESPACE)
+
+
+# bump when the snapshot markup changes
+WEEKLY_REPORT_VERSION = 1
+
+class WeeklyReport(db.Model):
+    """The rendered report for the week starting on its key name (YYYYMMDD)."""
+
+    html = db.TextProperty(default='')
+    data = db.TextProperty(default='')
+    etag = db.StringProperty(default='')
+    complete = db.BooleanProperty(default=False)
+    btime = db.DateTimeProperty(auto_now=True)
+    # snapshots older than WEEKLY_REPORT_VERSION are rebuilt
+    version = db.IntegerProperty(default=0)
+
+    @property
+    def current(self):
+        return self.complete and self.version == WEEKLY_REPORT_VERSION
+
+class WeekAggregate(db.Model):
+    """Live push totals for the week starting on its key name (YYYYMMDD).
+
+    Totals are kept per push, so recording a push twice or taking it back out
+    after an unlive leaves the week exact.
+    """
+
+    pushes_json = db.TextProperty(default='{}')
+    mtime = db.DateTimeProperty(auto_now=True)
+
+    def get_pushes(self):
+        return json.loads(self.pushes_json)
+
+    def set_pushes(self, pushes):
+        self.pushes_json = json.dumps(pushes)
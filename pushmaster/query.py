@@ -1,49 +1,123 @@
+import calendar
 import datetime
 
-from google.appengine.api import memcache
 from google.appengine.ext import db
 
-from pushmaster import model, timezone, util
+from pushmaster import cache, context, model, timezone, util
 
 
 CACHE_SECONDS = 60 * 60 * 24
 
+def entity_key(key):
+    return key if isinstance(key, db.Key) else db.Key(key)
+
+def get_entities(keys, model_class=None):
+    """Fetch entities by key, reading through the entity cache in one batch.
+
+    Keys may be db.Keys or their string forms; missing entities come back as None.
+    """
+    keys = map(entity_key, keys)
+    if model_class is not None:
+        for key in keys:
+            if key.kind() != model_class.kind():
+                raise db.KindError('Kind %r is not a subclass of kind %r' % (key.kind(), model_class.kind()))
+
+    names = map(str, keys)
+    cached = cache.get_multi(model.ENTITY_CACHE_NAMESPACE, names)
+
+    missing = [key for key, name in zip(keys, names) if name not in cached]
+    if missing:
+        found = dict((str(key), entity) for key, entity in zip(missing, db.get(missing)) if entity is not None)
+        if found:
+            cache.store_multi(model.ENTITY_CACHE_NAMESPACE, found, CACHE_SECONDS, add=True)
+        cached.update(found)
+
+    return [cached.get(name) for name in names]
+
+def get_push(key):
+    return get_entities([key], model.Push)[0]
+
+def get_request(key):
+    return get_entities([key], model.Request)[0]
+
+def request_push(request):
+    """request.push through the entity cache."""
+    push_key = model.Request.push.get_value_for_datastore(request)
+    return get_push(push_key) if push_key else None
+
+def push_version(push):
+    """A token that changes whenever push or its list of requests is written."""
+    return cache.stamp(push.cache_namespace)
+
+def push_changed(push):
+    """When push or its list of requests last changed, in seconds since the epoch."""
+    changed = cache.get(push.cache_namespace, model.PUSH_CHANGED_CACHE_KEY)
+    if changed is None:
+        changed = calendar.timegm(push.mtime.utctimetuple())
+    return changed
+
+PUSH_CHANGES_LIMIT = 200
+
+def push_changes(push, since=0, limit=PUSH_CHANGES_LIMIT):
+    """The entries in push's change log after sequence number since, oldest first."""
+    return model.PushChange.all().ancestor(push).filter('seq >', since).order('seq').fetch(limit)
+
+def sort_push_requests(requests):
+    return sorted(requests, key=lambda r: (not r.urgent, r.mtime))
+
+@context.memoize
 def push_requests(push, state=None):
-    requests = memcache.get(push.requests_cache_key)
+    requests = cache.get(push.cache_namespace, push.requests_cache_name)
     if requests is None:
-        requests = list(model.Request.all().filter('push =', push))
-        requests = sorted(requests, key=lambda r: (not r.urgent, r.mtime))
-        memcache.add(push.requests_cache_key, requests, CACHE_SECONDS)
+        requests, _ = cache.load(push.cache_namespace, push.requests_cache_name, lambda: sort_push_requests(model.Request.all().filter('push =', push)), CACHE_SECONDS)
 
     if state is not None:
         requests = filter(lambda r: r.state == state, requests)
 
     return requests
 
+def update_push_requests(push, *requests):
+    """Write the given requests through to push's cached request list.
+
+    Each request replaces its cached copy, is inserted if it now belongs to
+    push or is removed if it has left it.
+    """
+    push_key = push.key()
+    changed_keys = set(request.key() for request in requests)
+
+    def update(cached):
+        cached = [r for r in cached if r.key() not in changed_keys]
+        cached.extend(r for r in requests if model.Request.push.get_value_for_datastore(r) == push_key)
+        return sort_push_requests(cached)
+
+    cache.update(push.cache_namespace, push.requests_cache_name, update, CACHE_SECONDS)
+
+PUSH_CACHE_NAMESPACE = 'pushes'
 CURRENT_PUSH_CACHE_KEY = 'push-current'
 OPEN_PUSHES_CACHE_KEY = 'push-open'
 NO_CURRENT_PUSH = 'no-current-push'
 
+@context.memoize
 def current_push():
-    current_push = memcache.get(CURRENT_PUSH_CACHE_KEY)
-    if current_push is None:
+    def compute():
         states = ('accepting', 'onstage')
         current_pushes = list(model.Push.all().filter('state in', states).order('-ctime'))
-        current_push = current_pushes[-1] if current_pushes else None
-        memcache.add(CURRENT_PUSH_CACHE_KEY, current_push or NO_CURRENT_PUSH, CACHE_SECONDS)
-    elif current_push == NO_CURRENT_PUSH:
+        return current_pushes[-1] if current_pushes else NO_CURRENT_PUSH
+
+    current_push = cache.get_or_compute(PUSH_CACHE_NAMESPACE, CURRENT_PUSH_CACHE_KEY, compute, CACHE_SECONDS)
+    if current_push == NO_CURRENT_PUSH:
         return None
 
     return current_push
 
+@context.memoize
 def open_pushes():
-    open_pushes = memcache.get(OPEN_PUSHES_CACHE_KEY)
-    if open_pushes is None:
+    def compute():
         states = ('accepting', 'onstage', 'live')
         open_pushes = model.Push.all().filter('state in', states).order('-ctime').fetch(25)
-        open_pushes = sorted(open_pushes, key=lambda p: p.ptime, reverse=True)
-        memcache.add(OPEN_PUSHES_CACHE_KEY, open_pushes, 60 * 60)
-    return open_pushes
+        return sorted(open_pushes, key=lambda p: p.ptime, reverse=True)
+
+    return cache.get_or_compute(PUSH_CACHE_NAMESPACE, OPEN_PUSHES_CACHE_KEY, compute, 60 * 60)
 
 def pushes_for_user(user, limit=25):
     states = ('accepting', 'onstage', 'live')
@@ -56,21 +130,56 @@ def pushes_for_the_week_of(from_date):
         pushes = list(model.Push.all().filter('state =', 'live').filter('ltime >=', from_date).filter('ltime <', from_date + datetime.timedelta(days=7)).order('ltime'))
         return pushes
 
+QUERY_IN_LIMIT = 30
+
+def requests_for_pushes(pushes):
+    """All requests in pushes, fetched with push IN queries of up to 30 keys each."""
+    push_keys = [push.key() for push in pushes]
+    requests = []
+    for i in xrange(0, len(push_keys), QUERY_IN_LIMIT):
+        requests.extend(model.Request.all().filter('push IN', push_keys[i:i + QUERY_IN_LIMIT]))
+    return requests
+
 def bust_push_caches():
-    memcache.delete_multi([CURRENT_PUSH_CACHE_KEY, OPEN_PUSHES_CACHE_KEY])
+    cache.bust(PUSH_CACHE_NAMESPACE)
+
+REQUEST_CACHE_NAMESPACE = 'requests'
+CURRENT_REQUESTS_CACHE_KEY = 'request-snapshot'
+
+def sort_current_requests(requests, today):
+    request_key = lambda r: (not r.urgent, today if r.target_date < today else r.target_date, not r.tests_pass, r.mtime)
+    return sorted(requests, key=request_key)
 
-CURRENT_REQUESTS_CACHE_KEY = 'request-current'
+def current_requests_snapshot(requests, today):
+    return {'date': today, 'requests': sort_current_requests(requests, today)}
 
+@context.memoize
 def current_requests():
-    requests = memcache.get(CURRENT_REQUESTS_CACHE_KEY)
-    if requests is None:
-        requests = model.Request.all().filter('state =', 'requested')
-        memcache.add('request-current', requests, CACHE_SECONDS)
     today = util.tznow().date()
-    request_key = lambda r: (not r.urgent, today if r.target_date < today else r.target_date, not r.tests_pass, r.mtime)
-    requests = sorted(requests, key=request_key)
-    return requests
 
+    def compute():
+        return current_requests_snapshot(model.Request.all().filter('state =', 'requested'), today)
+
+    snapshot = cache.get_or_compute(REQUEST_CACHE_NAMESPACE, CURRENT_REQUESTS_CACHE_KEY, compute, CACHE_SECONDS)
+    if snapshot['date'] != today:
+        # overdue requests rank as due today, so the order changes at midnight
+        snapshot = current_requests_snapshot(snapshot['requests'], today)
+        cache.update(REQUEST_CACHE_NAMESPACE, CURRENT_REQUESTS_CACHE_KEY, lambda cached: current_requests_snapshot(cached['requests'], today), CACHE_SECONDS, stale=True)
+
+    return snapshot['requests']
+
+def update_current_requests(*requests):
+    """Write the given requests through to the pending request snapshot."""
+    changed_keys = set(request.key() for request in requests)
+
+    def update(snapshot):
+        cached = [r for r in snapshot['requests'] if r.key() not in changed_keys]
+        cached.extend(r for r in requests if r.state == 'requested')
+        return current_requests_snapshot(cached, snapshot['date'])
+
+    cache.update(REQUEST_CACHE_NAMESPACE, CURRENT_REQUESTS_CACHE_KEY, update, CACHE_SECONDS, stale=True)
+
+@context.memoize
 def pending_requests(not_after=None):
     requests = current_requests()
     requests = filter(lambda r: r.state == model.Request.default_state, requests)
@@ -84,26 +193,122 @@ def requests_for_user(user, limit=25):
     requests = sorted(requests, key=lambda r: (r.target_date, r.ctime), reverse=True)
     return requests
 
+USER_INFO_CACHE_NAMESPACE = model.USER_INFO_CACHE_NAMESPACE
+# cached for users without a UserInfo, so looking them up again skips the datastore
+NO_USER_INFO = False
+
+@context.memoize
 def info_for_user(user):
     if user is None:
         return None
 
-    user_info = memcache.get('user-info-%s' % user.nickname())
+    cache_name = model.UserInfo.cache_name_for(user)
+    user_info = cache.get(USER_INFO_CACHE_NAMESPACE, cache_name)
     if user_info is None:
-        user_info = model.UserInfo.all().filter('user =', user).get()
-        if user_info is not None:
-            memcache.add('user-info-%s' % user.nickname(), user_info, CACHE_SECONDS)
-    return user_info
+        user_info = model.UserInfo.get_by_user(user)
+        cache.add(USER_INFO_CACHE_NAMESPACE, cache_name, NO_USER_INFO if user_info is None else user_info, CACHE_SECONDS)
+    cache.count('user-info.single')
+    return user_info or None
+
+def infos_for_users(users):
+    """Map each of users to its UserInfo with one memcache and one datastore batch.
+
+    Users without a UserInfo are left out.
+    """
+    users = list(set(user for user in users if user is not None))
+    cache_names = map(model.UserInfo.cache_name_for, users)
+    cached = cache.get_multi(USER_INFO_CACHE_NAMESPACE, cache_names)
+
+    user_infos = {}
+    missing = []
+    for user, cache_name in zip(users, cache_names):
+        if cache_name not in cached:
+            missing.append(user)
+        elif cached[cache_name] is not NO_USER_INFO:
+            user_infos[user] = cached[cache_name]
+
+    found = {}
+    if missing:
+        for user, user_info in zip(missing, model.UserInfo.get_by_user(missing)):
+            if user_info is not None:
+                user_infos[user] = user_info
+            found[model.UserInfo.cache_name_for(user)] = NO_USER_INFO if user_info is None else user_info
+    if found:
+        cache.store_multi(USER_INFO_CACHE_NAMESPACE, found, CACHE_SECONDS, add=True)
+
+    cache.count('user-info.batch')
+    return user_infos
+
+def bust_user_info_caches():
+    cache.bust(USER_INFO_CACHE_NAMESPACE)
 
 def bust_request_caches():
-    memcache.delete(CURRENT_REQUESTS_CACHE_KEY)
+    cache.bust(REQUEST_CACHE_NAMESPACE)
 
-def report_users_by_team():
-    users = model.ReportUser.all()
+ROSTER_CACHE_KEY = 'roster-index'
+
+def build_roster_index():
+    report_users = list(model.ReportUser.all())
 
     teams = {}
-    for u in users:
+    for u in report_users:
         for t in u.teams:
             teams.setdefault(t, {}).setdefault(u.role, []).append(u.user.nickname())
+    for team in teams.itervalues():
+        for nicknames in team.itervalues():
+            nicknames.sort()
+
+    user_infos = infos_for_users([u.user for u in report_users])
+    names = {}
+    for u in report_users:
+        user_info = user_infos.get(u.user)
+        names[u.user.nickname()] = user_info.full_name if user_info else u.user.nickname()
+
+    return {'version': cache.generation(model.ROSTER_CACHE_NAMESPACE), 'teams': teams, 'names': names}
+
+@context.memoize
+def roster_index():
+    """Report users as team -> role -> sorted nicknames, plus their full names.
+
+    Writing a ReportUser or UserInfo busts the roster namespace, which is the
+    only time the index is rebuilt.
+    """
+    return cache.get_or_compute(model.ROSTER_CACHE_NAMESPACE, ROSTER_CACHE_KEY, build_roster_index, CACHE_SECONDS)
+
+def rebuild_roster_index():
+    cache.bust(model.ROSTER_CACHE_NAMESPACE)
+    return cache.fill(model.ROSTER_CACHE_NAMESPACE, ROSTER_CACHE_KEY, build_roster_index, CACHE_SECONDS)
+
+def report_users_by_team():
+    return roster_index()['teams']
+
+def teams_by_dev():
+    """Map each report user's nickname to the sorted teams they are on."""
+    dev_teams = {}
+    for team_name, team in report_users_by_team().iteritems():
+        for nicknames in team.itervalues():
+            for nickname in nicknames:
+                dev_teams.setdefault(nickname, set()).add(team_name)
+    return dict((nickname, sorted(teams)) for nickname, teams in dev_teams.iteritems())
+
+def week_aggregates(datestrs):
+    return model.WeekAggregate.get_by_key_name(datestrs)
+
+cache.warm_namespaces.update([PUSH_CACHE_NAMESPACE, REQUEST_CACHE_NAMESPACE, USER_INFO_CACHE_NAMESPACE, model.ROSTER_CACHE_NAMESPACE, model.ENTITY_CACHE_NAMESPACE])
+
+# push-html counts the leases on rendered push pages in the view
+LEASED_CACHE_KEYS = (CURRENT_PUSH_CACHE_KEY, OPEN_PUSHES_CACHE_KEY, CURRENT_REQUESTS_CACHE_KEY, ROSTER_CACHE_KEY, 'push-html')
+
+USER_INFO_STATS = ('user-info.batch', 'user-info.single')
+
+# counted by the view's fragment caches
+FRAGMENT_STATS = ('fragment.item', 'fragment.push')
+
+# push page polls that waited for a change, and those turned away to poll later
+LONG_POLL_STATS = ('long-poll.wait', 'long-poll.gated')
 
-    return teams
+def cache_stats():
+    stats = list(USER_INFO_STATS) + list(LONG_POLL_STATS)
+    for name in LEASED_CACHE_KEYS:
+        stats.extend(cache.lease_stats(name))
+    return {'counts': cache.counts(stats), 'tiers': cache.tier_stats(), 'fragments': cache.hit_stats(FRAGMENT_STATS)}
@@ -1,15 +1,22 @@
 import cgi
+import re
 
 __author__ = 'Jeremy Latt <jlatt@yelp.com>'
-__all__ = ('T', 'Literal', 'Text', 'XHTML')
+__all__ = ('T', 'Literal', 'Text', 'XHTML', 'Hole', 'Template', 'compile_tags')
 
-def iterflat(args):
+escape = cgi.escape
+
+def flatten_into(children, args):
     for arg in args:
         if hasattr(arg, '__iter__'):
-            for a in iterflat(arg):
-                yield a
+            flatten_into(children, arg)
         else:
-            yield arg
+            children.append(arg)
+
+def iterflat(args):
+    children = []
+    flatten_into(children, args)
+    return children
 
 def translate(attrs):
     for key, value in attrs.iteritems():
@@ -18,96 +25,168 @@ def translate(attrs):
 
         yield (key, value)
 
-def iterattrs(attrs):
-    for key, value in attrs.iteritems():
-        if isinstance(value, bool):
-            if value:
-                value = key
-            else: # skip False
+# ' key="' for every attribute name seen so far
+attr_prefixes = {}
+
+def attr_prefix(key):
+    try:
+        return attr_prefixes[key]
+    except KeyError:
+        prefix = attr_prefixes[key] = u' %s="' % escape(key)
+        return prefix
+
+close_tags = {}
+
+def close_tag(tagname):
+    try:
+        return close_tags[tagname]
+    except KeyError:
+        tag = close_tags[tagname] = u'</%s>' % tagname
+        return tag
+
+EMPTY_TAGS = frozenset(('link', 'input', 'hr', 'meta'))
+
+def write_nodes(root, out):
+    """Append the serialization of root to the list out.
+
+    Tags are walked with an explicit stack instead of recursion. Anything else
+    with a serialize method writes itself through write_to.
+    """
+    append = out.append
+    stack = [root]
+    pop = stack.pop
+    push = stack.append
+    while stack:
+        node = pop()
+        cls = node.__class__
+        if cls is unicode or cls is str:
+            # close tags and children escaped when their parent was opened
+            append(node)
+        elif cls is _Tag or isinstance(node, _Tag):
+            tagname = node.tagname
+            append(u'<' + tagname)
+            for key, value in node.attrs.iteritems():
+                if value is True:
+                    value = key
+                elif value is False:
+                    continue
+                elif value.__class__ is not unicode:
+                    value = unicode(value)
+                append(attr_prefix(key) + escape(value, True) + u'"')
+
+            children = node.children
+            if tagname in EMPTY_TAGS:
+                assert not children, 'empty tag %s has children' % tagname
+                append(u'/>')
                 continue
+
+            append(u'>')
+            push(close_tag(tagname))
+            for child in reversed(children):
+                cls = child.__class__
+                if cls is unicode:
+                    push(escape(child))
+                elif cls is _Tag or hasattr(child, 'serialize'):
+                    push(child)
+                else:
+                    push(escape(unicode(child)))
+        elif isinstance(node, StrSerializable):
+            node.write_to(out)
         else:
-            value = unicode(value)
+            node.serialize(ListWriter(out))
 
-        yield (key, value)
+class ListWriter(object):
+    """A file-like object that appends to a list."""
+
+    __slots__ = ('write',)
+
+    def __init__(self, out):
+        self.write = out.append
 
 class StrSerializable(object):
+    __slots__ = ()
+
     def __unicode__(self):
-        from StringIO import StringIO
-        f = self.serialize(StringIO())
-        strval = f.getvalue()
-        f.close()
-        return strval
+        out = []
+        self.write_to(out)
+        return u''.join(out)
 
     def __str__(self):
         return unicode(self).encode('utf-8')
     
     __repr__ = __str__
 
+    def write_to(self, out):
+        self.serialize(ListWriter(out))
+
     def serialize(self, f):
         raise NotImplemented
 
 class _Tag(StrSerializable):
-    empty = set(('link', 'input', 'hr', 'meta'))
+    __slots__ = ('tagname', 'children', 'attrs')
+
+    empty = EMPTY_TAGS
 
     def __init__(self, tagname, *children, **attrs):
-        assert tagname == cgi.escape(tagname), 'illegal tag name %s' % tagname
+        assert tagname == escape(tagname), 'illegal tag name %s' % tagname
 
         self.tagname = tagname
-        self.children = list(iterflat(children))
+        self.children = []
+        flatten_into(self.children, children)
         self.attrs = dict(translate(attrs))
 
     def __call__(self, *children, **attrs):
         if children:
-            self.children.extend(iterflat(children))
+            flatten_into(self.children, children)
         if attrs:
             self.attrs.update(translate(attrs))
         return self
 
-    def serialize(self, f):
-        is_empty = self.tagname in self.empty
-        open_tag_end = '>'
-        if is_empty:
-            assert not self.children, 'empty tag %s has children' % self.tagname
-            open_tag_end = '/>'
-
-        # open tag
-        formatted_attrs = ''.join([' %s="%s"' % (cgi.escape(key), cgi.escape(value, quote=True)) for key, value in iterattrs(self.attrs)])
-        f.write('<%s%s%s' % (self.tagname, formatted_attrs, open_tag_end))
-
-        for child in self.children:
-            if hasattr(child, 'serialize'):
-                child.serialize(f)
-            else:
-                f.write(cgi.escape(unicode(child)))
-        
-        if not is_empty:
-            f.write('</%s>' % self.tagname)
+    def write_to(self, out):
+        write_nodes(self, out)
 
+    def serialize(self, f):
+        f.write(unicode(self))
         return f
 
 class Literal(StrSerializable):
+    __slots__ = ('html',)
+
     def __init__(self, html):
         self.html = unicode(html)
 
+    def write_to(self, out):
+        out.append(self.html)
+
     def serialize(self, f):
         f.write(self.html)
         return f
 
 class Text(StrSerializable):
+    __slots__ = ('text',)
+
     def __init__(self, text):
         self.text = unicode(text)
 
+    def write_to(self, out):
+        out.append(escape(self.text))
+
     def serialize(self, f):
-        f.write(cgi.escape(self.text))
+        f.write(escape(self.text))
         return f
 
 class CData(StrSerializable):
+    __slots__ = ('value',)
+
     begin = '<![CDATA['
     end = ']]>'
 
     def __init__(self, value):
         self.value = unicode(value)
 
+    def write_to(self, out):
+        out.extend((self.begin, self.value, self.end))
+
     def serialize(self, f):
         f.write(self.begin)
         f.write(self.value)
@@ -115,6 +194,8 @@ class CData(StrSerializable):
         return f
 
 class ScriptCData(CData):
+    __slots__ = ()
+
     begin = '/* %s */' % CData.begin
     end = '/* %s */' % CData.end
 
@@ -136,6 +217,74 @@ class XHTML(StrSerializable):
         self.html(*args, **kw)
         return self
 
+HOLE_MARK = u'\x00%s\x00'
+hole_re = re.compile(u'\x00([^\x00]+)\x00')
+# a hole that is an attribute's whole value, e.g. checked=Hole('urgent')
+attr_hole_re = re.compile(u' ([^\\s=]+)="\x00([^\x00]+)\x00"')
+
+class Hole(StrSerializable):
+    """A named placeholder for per-request data in a Template."""
+
+    __slots__ = ('name',)
+
+    def __init__(self, name):
+        self.name = name
+
+    def __unicode__(self):
+        return HOLE_MARK % self.name
+
+    def write_to(self, out):
+        out.append(unicode(self))
+
+    def serialize(self, f):
+        f.write(unicode(self))
+        return f
+
+class Template(object):
+    """Tags serialized once into a format string, with Holes filled per render.
+
+    Values are escaped unless they are tags or Literals. A hole that is the
+    whole value of an attribute drops the attribute for False or None and
+    repeats its name for True, like boolean attributes of ordinary tags.
+    """
+
+    def __init__(self, *tags):
+        html = u''.join(map(unicode, tags)).replace('%', '%%')
+        self.attrs = dict((name, key) for key, name in attr_hole_re.findall(html))
+        html = attr_hole_re.sub(lambda m: '%%(@%s)s' % m.group(2), html)
+        self.names = set(hole_re.findall(html)) | set(self.attrs)
+        self.format = hole_re.sub(lambda m: '%%(%s)s' % m.group(1), html)
+
+    def render(self, **values):
+        filled = dict((name, fill_hole(values[name])) for name in self.names)
+        for name, key in self.attrs.iteritems():
+            value = values[name]
+            if value is None or value is False:
+                filled['@' + name] = u''
+            elif value is True:
+                filled['@' + name] = u' %s="%s"' % (key, key)
+            else:
+                filled['@' + name] = u' %s="%s"' % (key, filled[name])
+
+        return Literal(self.format % filled)
+
+def fill_hole(value):
+    if hasattr(value, 'serialize'):
+        return unicode(value)
+    if value is None:
+        return u''
+    return cgi.escape(unicode(value), quote=True)
+
+def compile_tags(*tags):
+    """Serialize tags once for reuse on every request.
+
+    Tags without Holes become a Literal; otherwise the result is a Template.
+    """
+    template = Template(*tags)
+    if template.names:
+        return template
+    return Literal(template.format % {})
+
 class TagFactory(object):
     """Tag wrapper that lets you use normal Tag syntax (i.e. T('head')(...)) as
     well as "manifested" syntax like T.head(...).
@@ -1,12 +1,17 @@
+import datetime
 import logging
 
+from django.utils import simplejson as json
 from google.appengine.api import mail
 from google.appengine.api import users
+from google.appengine.api.labs import taskqueue
+from google.appengine.ext import db
 from google.appengine.ext import webapp
 from google.appengine.ext.webapp.util import run_wsgi_app
 
-from pushmaster import config, urls, util
+from pushmaster import cache, config, logic, model, query, urls, util
 from pushmaster.view import RequestHandler
+from pushmaster.view import report
 
 log = logging.getLogger('pushmaster.tasks')
 
@@ -40,6 +45,142 @@ class AsyncXMPPHandler(RequestHandler):
         log.debug('sending im: to=%s, message=%s', to, message)
         util.maybe_send_im(to, message)
 
+class MigrateUserKeysHandler(RequestHandler):
+    """Rewrite UserInfo and ReportUser rows as entities keyed by user email.
+
+    GET starts a run for every kind; each POST moves one batch and queues the
+    next one.
+    """
+
+    kinds = dict((cls.kind(), cls) for cls in (model.UserInfo, model.ReportUser))
+    batch_size = 100
+
+    def get(self):
+        for kind in self.kinds:
+            self.queue_batch(kind)
+        self.response.out.write('queued %s' % ', '.join(sorted(self.kinds)))
+
+    def queue_batch(self, kind, cursor=None):
+        params = dict(kind=kind, cursor=cursor) if cursor else dict(kind=kind)
+        taskqueue.Queue(name='default').add(taskqueue.Task(url=urls.migrate_user_keys_task, params=params))
+
+    def post(self):
+        kind = self.request.get('kind')
+        cls = self.kinds[kind]
+
+        q = cls.all().order('__key__')
+        cursor = self.request.get('cursor')
+        if cursor:
+            q.with_cursor(cursor)
+        entities = q.fetch(self.batch_size)
+
+        old_entities = [e for e in entities if e.user is not None and e.key().name() != cls.key_name_for(e.user)]
+        if old_entities:
+            existing = cls.get_by_user([e.user for e in old_entities])
+            new_entities = {}
+            for entity, current in zip(old_entities, existing):
+                if current is None:
+                    values = dict((name, getattr(entity, name)) for name in entity.properties())
+                    new_entity = cls(key_name=cls.key_name_for(entity.user), **values)
+                    new_entities[new_entity.key()] = new_entity
+            db.put(new_entities.values())
+            db.delete(old_entities)
+            log.info('migrated %d of %d %s entities', len(new_entities), len(old_entities), kind)
+
+        if len(entities) == self.batch_size:
+            self.queue_batch(kind, q.cursor())
+        else:
+            query.bust_user_info_caches()
+            cache.bust(model.ROSTER_CACHE_NAMESPACE)
+            log.info('finished migrating %s entities', kind)
+
+class BackfillMessageHtmlHandler(RequestHandler):
+    """Store linkified message HTML on requests that lack a current copy.
+
+    GET starts a run; each POST updates one batch and queues the next one.
+    """
+
+    batch_size = 100
+
+    def get(self):
+        self.queue_batch()
+        self.response.out.write('queued message html backfill')
+
+    def queue_batch(self, cursor=None):
+        params = dict(cursor=cursor) if cursor else {}
+        taskqueue.Queue(name='default').add(taskqueue.Task(url=urls.backfill_message_html_task, params=params))
+
+    def post(self):
+        q = model.Request.all().order('__key__')
+        cursor = self.request.get('cursor')
+        if cursor:
+            q.with_cursor(cursor)
+        requests = q.fetch(self.batch_size)
+
+        stale = [r for r in requests if r.message_html_version != util.LINKIFY_VERSION]
+        for request in stale:
+            logic.set_message_html(request)
+        if stale:
+            # a backfill is not an edit, so keep mtime and muser as they were
+            tracked = ((model.Request.mtime, 'auto_now'), (model.Request.muser, 'auto_current_user'))
+            for prop, flag in tracked:
+                setattr(prop, flag, False)
+            try:
+                db.put(stale)
+            finally:
+                for prop, flag in tracked:
+                    setattr(prop, flag, True)
+            log.info('stored message html for %d of %d requests', len(stale), len(requests))
+
+            # push request lists hold their own copies, which write-throughs would put back
+            push_keys = set(model.Request.push.get_value_for_datastore(r) for r in stale)
+            push_keys.discard(None)
+            pushes = filter(None, model.Push.get(list(push_keys)))
+            cache.bust(*[push.cache_namespace for push in pushes])
+
+        if len(requests) == self.batch_size:
+            self.queue_batch(q.cursor())
+        else:
+            # db.put skips TrackedModel.put, so drop cached copies in bulk
+            cache.bust(model.ENTITY_CACHE_NAMESPACE)
+            query.bust_request_caches()
+            log.info('finished message html backfill')
+
+class WeeklyReportHandler(RequestHandler):
+    """Snapshot weekly reports.
+
+    Cron GETs this to snapshot the week that just ended; POSTs from the task
+    queue rebuild the week given by date (YYYYMMDD of its Monday).
+    """
+
+    def get(self):
+        last_week = util.tznow() - datetime.timedelta(days=7)
+        self.build(util.week_datestr(last_week))
+
+    def post(self):
+        self.build(self.request.get('date'))
+
+    def build(self, datestr):
+        # recounting is cheap and backfills weeks from before aggregates
+        logic.rebuild_week_aggregate(datestr, report.report_date_range(datestr)[0])
+
+        existing = model.WeeklyReport.get_by_key_name(datestr)
+        if existing is not None and existing.current:
+            log.debug('report for %s is already complete', datestr)
+            return
+
+        built = report.build_week_report(datestr)
+        log.info('built %s report for %s', 'complete' if built.complete else 'partial', datestr)
+
+class RebuildRosterHandler(RequestHandler):
+    """Rebuild the cached roster index, e.g. after editing report users by hand."""
+
+    def get(self):
+        roster = query.rebuild_roster_index()
+        log.info('rebuilt roster version %s with %d teams', roster['version'], len(roster['teams']))
+        self.response.headers['Content-Type'] = 'application/json'
+        json.dump(roster, self.response.out)
+
 #
 # the app
 #
@@ -47,6 +188,10 @@ class AsyncXMPPHandler(RequestHandler):
 wsgi_app = [
     (urls.mail_task, AsyncMailHandler),
     (urls.xmpp_task, AsyncXMPPHandler),
+    (urls.migrate_user_keys_task, MigrateUserKeysHandler),
+    (urls.report_task, WeeklyReportHandler),
+    (urls.roster_task, RebuildRosterHandler),
+    (urls.backfill_message_html_task, BackfillMessageHtmlHandler),
     ]
 
 def main():
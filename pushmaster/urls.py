@@ -32,3 +32,11 @@ def static_url(path):
 mail_task = '/tasks/mail'
 
 xmpp_task = '/tasks/xmpp'
+
+migrate_user_keys_task = '/tasks/migrate/userkeys'
+
+report_task = '/tasks/report'
+
+roster_task = '/tasks/roster'
+
+backfill_message_html_task = '/tasks/backfill/messagehtml'
@@ -2,15 +2,36 @@ import cgi
 import datetime
 import logging
 import os
+import re
 
 from google.appengine.api import xmpp
 from google.appengine.api.labs import taskqueue
 
-from pushmaster import config, timezone, urls
+from pushmaster import config, context, timezone, urls
 
 
 log = logging.getLogger('pushmaster.util')
 
+linkify_re = re.compile(r'\b(https?://[^\s]+)', re.MULTILINE | re.IGNORECASE)
+http_re = re.compile(r'https?://', re.IGNORECASE)
+
+# bump whenever linkify's output changes so stored message HTML is rebuilt
+LINKIFY_VERSION = 1
+
+def linkify(text):
+    """Escape text as HTML, turning URLs into links and newlines into breaks."""
+    if not text:
+        return u''
+
+    parts = []
+    for part in linkify_re.split(text):
+        m = http_re.match(part)
+        if m:
+            parts.append('<a href="%s">%s</a>' % (cgi.escape(part, quote=True), cgi.escape(part)))
+        else:
+            parts.append(cgi.escape(part))
+    return u''.join(parts).replace('\n', '<br/>')
+
 def send_mail(**kw):
     required = ('to', 'subject', 'body')
     for key in required:
@@ -28,8 +49,32 @@ def send_im(to=None, message=None, **kw):
         message = message % kw
     taskqueue.Queue(name='xmpp').add(taskqueue.Task(url=urls.xmpp_task, params=dict(to=to, message=message)))
 
+def week_datestr(dt):
+    """The YYYYMMDD of the Monday that starts dt's report week."""
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.UTC())
+    d = dt.astimezone(config.tzinfo).date()
+    return (d - datetime.timedelta(days=d.weekday())).strftime('%Y%m%d')
+
+def week_datestrs(from_dt, to_dt):
+    """The week_datestr of every week from from_dt's through to_dt's."""
+    monday = datetime.datetime.strptime(week_datestr(from_dt), '%Y%m%d')
+    last = week_datestr(to_dt)
+    datestrs = []
+    while monday.strftime('%Y%m%d') <= last:
+        datestrs.append(monday.strftime('%Y%m%d'))
+        monday += datetime.timedelta(days=7)
+    return datestrs
+
+def queue_week_report(dt, name=None):
+    """Queue a rebuild of dt's weekly report. Named tasks are queued at most once."""
+    try:
+        taskqueue.Queue(name='default').add(taskqueue.Task(url=urls.report_task, params=dict(date=week_datestr(dt)), name=name))
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+        log.debug('report task %s was already queued', name)
+
 def tznow(tz=config.tzinfo):
-    return datetime.datetime.now(tz)
+    return context.now().astimezone(tz)
 
 def choose_strftime_format(dt):
     now = tznow()
@@ -71,6 +116,9 @@ def choose_date_strftime_format(d):
 def format_date(d):
     return d.strftime(choose_date_strftime_format(d))
 
+def format_absolute_date(d):
+    return d.strftime('%e %b %Y')
+
 def maybe_send_im(to, msg):
     if xmpp.get_presence(to):
         xmpp.send_message(to, '<html xmlns="http://jabber.org/protocol/xhtml-im"><body xmlns="http://www.w3.org/1999/xhtml">%s</body></html>' % msg, raw_xml=True)
@@ -20,6 +20,21 @@ class RequestHandler(webapp.RequestHandler):
     def hostname(self):
         return self.request.headers['Host']
 
+    def get_request_header_list(self, header, default=''):
+        hval = self.request.headers.get(header, default)
+        return [part.strip() for part in hval.split(',')]
+
+    def not_modified(self, etag):
+        """Send etag and answer 304 Not Modified if the client already has it."""
+        self.response.headers['ETag'] = etag
+        if etag in self.get_request_header_list('If-None-Match'):
+            self.response.set_status(httplib.NOT_MODIFIED)
+            return True
+        return False
+
+    def write_document(self, doc):
+        doc.serialize(self.response.out)
+
     def set_error(self, debug_mode, code=httplib.INTERNAL_SERVER_ERROR, message=None):
         message = message or httplib.responses.get(code, 'Unknown Error')
         self.error(code)
@@ -15,7 +15,7 @@ from pushmaster.view import HTTPStatusCode
 from pushmaster.view import RequestHandler
 
 __author__ = 'Matt Jones <mattj@yelp.com>'
-__all__ = ('Pushes', 'EditPush')
+__all__ = ('Pushes', 'EditPush', 'PushChanges')
 
 log = logging.getLogger('pushmaster.view.api')
 
@@ -33,10 +33,10 @@ class Request(RequestHandler):
     def get(self, request_key):
         """Show a request."""
         try:
-            request = model.Request.get(request_key)
+            request = query.get_request(request_key)
             self.response.headers['Content-Type'] = 'application/json'
             data = request.json
-            data['message_html'] = unicode(common.linkify(request.message or ''))
+            data['message_html'] = unicode(common.message_html(request))
             self.response.out.write(json.dumps(data))
         except BadKeyError:
             raise HTTPStatusCode(httplib.NOT_FOUND)
@@ -61,11 +61,17 @@ class EditPush(RequestHandler):
             return
 
         try:
-            push = model.Push.get(push_id)
+            push = query.get_push(push_id)
         except BadKeyError:
             raise HTTPStatusCode(httplib.NOT_FOUND)
 
         current_user = users.get_current_user()
+        self.response.headers['Cache-Control'] = 'no-store'
+        poll_interval = common.push_poll_interval(push)
+        self.response.headers['X-Poll-Interval'] = str(poll_interval)
+        if self.not_modified(common.push_etag(push, current_user)):
+            return
+
         pending_requests = query.pending_requests(not_after=util.tznow().date()) if current_user == push.owner else []
 
         requests = query.push_requests(push)
@@ -73,11 +79,10 @@ class EditPush(RequestHandler):
         push_info = self.render_push_info(push, requests)
         request_info = self.render_request_info(pending_requests)
 
-        response = {'push': push_info, 'pending_requests': request_info}
+        response = {'push': push_info, 'pending_requests': request_info, 'poll_interval': poll_interval}
 
         self.response.headers['Vary'] = 'Accept'
         self.response.headers['Content-Type'] = 'application/json'
-        self.response.headers['Cache-Control'] = 'no-store'
 
         self.response.out.write(json.dumps(response))
 
@@ -91,6 +96,43 @@ class EditPush(RequestHandler):
         return [r.json for r in pending_requests]
 
 
+class PushChanges(RequestHandler):
+    def get(self, push_id):
+        """List a push's changes after the sequence number in since."""
+        try:
+            push = query.get_push(push_id)
+        except BadKeyError:
+            raise HTTPStatusCode(httplib.NOT_FOUND)
+
+        try:
+            since = int(self.request.get('since') or 0)
+        except ValueError:
+            raise HTTPStatusCode(httplib.BAD_REQUEST)
+
+        self.response.headers['Cache-Control'] = 'no-store'
+        if self.not_modified('"%d-%s"' % (since, query.push_version(push))):
+            return
+
+        changes = query.push_changes(push, since)
+        response = {
+            'push': {'key': unicode(push.key()), 'state': push.state, 'stage': push.stage},
+            'seq': changes[-1].seq if changes else since,
+            'more': len(changes) == query.PUSH_CHANGES_LIMIT,
+            'changes': [change.json for change in changes],
+            }
+
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.out.write(json.dumps(response))
+
+
+class CacheStats(RequestHandler):
+    def get(self):
+        """Show cache counters and hit ratios"""
+        self.response.headers['Cache-Control'] = 'no-cache'
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.out.write(json.dumps(query.cache_stats()))
+
+
 class Search(RequestHandler):
     def get(self):
         self.response.headers['Cache-Control'] = 'no-cache'
@@ -1,30 +1,22 @@
-import cgi
-import re
+
+import hashlib
+import os
+import time
 
 from google.appengine.api import users
 
-from pushmaster import config, logic, model, timezone, urls, util, query
-from pushmaster.taglib import Literal, T, XHTML
+from pushmaster import cache, config, logic, model, timezone, urls, util, query
+from pushmaster.taglib import compile_tags, Hole, Literal, T, XHTML
 import www
 
-linkify_re = re.compile(r'\b(https?://[^\s]+)', re.MULTILINE | re.IGNORECASE)
-http_re = re.compile(r'https?://', re.IGNORECASE)
-
-def linkify_repl(m):
-    return m.group(1) + link + m.group(3)
-
 def linkify(text):
-    if not text:
-        return ''
-
-    parts = []
-    for part in linkify_re.split(text):
-        m = http_re.match(part)
-        if m:
-            parts.append('<a href="%s">%s</a>' % (cgi.escape(part, quote=True), cgi.escape(part)))
-        else:
-            parts.append(cgi.escape(part))
-    return Literal(''.join(parts).replace('\n', '<br/>'))
+    return Literal(util.linkify(text))
+
+def message_html(request):
+    """The request's message as HTML, from its stored copy when that is current."""
+    if request.message_html_version == util.LINKIFY_VERSION:
+        return Literal(request.message_html)
+    return linkify(request.message)
 
 def display_datetime(dt):
     return T.span(class_='datetime')(util.format_datetime(dt))
@@ -54,11 +46,18 @@ def funcbar():
         )
     return bar
 
-def session():
+def page_user_infos(*user_lists):
+    """Resolve the UserInfo of the viewer and every user in user_lists in one batch."""
+    page_users = [users.get_current_user()]
+    for user_list in user_lists:
+        page_users.extend(user_list)
+    return logic.user_infos(page_users)
+
+def session(user_infos):
     user = users.get_current_user()
 
     div = T.div(class_='session')(
-        user_home_link(user, logic.user_info(user)),
+        user_home_link(user, user_infos[user]),
         T.span(class_='sep')('|'),
         T.a(href=users.create_logout_url('/'))('Logout')
     )
@@ -101,18 +100,23 @@ request_flags_badge_map = (
 def request_badges(request):
     return [badge(request) for flag, badge in request_flags_badge_map if getattr(request, flag)]
 
-def request_item(request):
+def request_item(request, user_infos, snapshot=False):
+    """A request's list item.
+
+    Snapshot items are the same for every viewer on every day: they show
+    absolute dates and leave out the future and own classes.
+    """
     li = T.li(class_='request clearfix')(
-        display_date(request.target_date),
+        T.span(class_='date')(util.format_absolute_date(request.target_date)) if snapshot else display_date(request.target_date),
         ' ',
-        T.span(class_='email')(T.a(href=urls.user_home(request.owner))(logic.user_info(request.owner).full_name), ':'),
+        T.span(class_='email')(T.a(href=urls.user_home(request.owner))(user_infos[request.owner].full_name), ':'),
         ' ',
         T.a(href=request.uri, class_='request-subject')(request.subject),
         ' ',
         T.span(class_='verify')(request.time_to_verify),
         )
 
-    if request.target_date > util.tznow().date():
+    if not snapshot and request.target_date > util.tznow().date():
         li.attrs['class'] += ' future'
 
     if request.urgent:
@@ -121,7 +125,7 @@ def request_item(request):
     if request.state == 'rejected':
         li.attrs['class'] += ' rejected'
 
-    if request.owner == users.get_current_user():
+    if not snapshot and request.owner == users.get_current_user():
         li.attrs['class'] += ' own'
 
     if request.branch and '/' in request.branch:
@@ -137,13 +141,99 @@ def request_item(request):
         ' ',
         request_branch,
         ' ',
-        T.div(linkify(request.message), class_='message'),
+        T.div(message_html(request), class_='message'),
         )
 
     return li
 
-def request_list(requests):
-    return T.ol(class_='requests')(map(request_item, requests))
+FRAGMENT_SECONDS = 24 * 60 * 60
+
+def viewer_role(request):
+    return 'own' if request.owner == users.get_current_user() else ''
+
+cache.warm_namespaces.add(model.FRAGMENT_CACHE_NAMESPACE)
+
+# every deploy may change item markup, so fragments don't outlive the version that rendered them
+FRAGMENT_APP_VERSION = os.environ.get('CURRENT_VERSION_ID', '')
+
+def fragment_name(variant, request, role, today):
+    parts = (variant, request.key(), request.mtime.isoformat(), util.LINKIFY_VERSION, FRAGMENT_APP_VERSION, role, today.isoformat())
+    return 'f' + hashlib.md5('-'.join(map(str, parts))).hexdigest()
+
+def fragment_id(name):
+    """The id of a fragment's element, which pages use to patch it in place."""
+    return name[:11]
+
+def fragment_names(variant, requests, role=viewer_role):
+    today = util.tznow().date()
+    return [fragment_name(variant, request, role(request), today) for request in requests]
+
+def cached_request_items(variant, requests, render, role=viewer_role):
+    """Render render(request) for each of requests, reusing serialized HTML.
+
+    Fragments are keyed by variant, the request's key and mtime, role(request)
+    for whatever about the viewer changes the markup, and today's date, which
+    decides the future class. A changed request or a new day misses and
+    renders afresh.
+    """
+    names = fragment_names(variant, requests, role)
+    return [Literal(html) for html in request_fragments(requests, names, render)]
+
+def request_fragments(requests, names, render):
+    """The serialized items named names for requests, rendering the ones not cached."""
+    cached = cache.get_multi(model.FRAGMENT_CACHE_NAMESPACE, names)
+    cache.count('fragment.item.hit', len(cached))
+    cache.count('fragment.item.miss', len(requests) - len(cached))
+
+    fragments = []
+    rendered = {}
+    for request, name in zip(requests, names):
+        html = cached.get(name)
+        if html is None:
+            li = render(request)
+            li.attrs['id'] = fragment_id(name)
+            html = rendered[name] = unicode(li)
+        fragments.append(html)
+    if rendered:
+        cache.store_multi(model.FRAGMENT_CACHE_NAMESPACE, rendered, FRAGMENT_SECONDS)
+    return fragments
+
+def push_etag_namespaces(push):
+    return [push.cache_namespace, model.FRAGMENT_CACHE_NAMESPACE, query.REQUEST_CACHE_NAMESPACE]
+
+def push_etag(push, current_user):
+    """An ETag for what current_user sees of push, computed without loading its requests."""
+    parts = [query.push_version(push), cache.stamp(model.FRAGMENT_CACHE_NAMESPACE), util.tznow().date().isoformat(), current_user.email()]
+    if current_user == push.owner:
+        # pushmasters also see pending requests
+        parts.append(cache.stamp(query.REQUEST_CACHE_NAMESPACE))
+    return '"%s"' % hashlib.md5(repr(parts)).hexdigest()
+
+# (seconds since the last change, poll interval) for open pushes, where onstage
+# pushes use the first interval and accepting ones the second; clients long-poll
+# again at once while a push is busy
+POLL_INTERVALS = (
+    (5 * 60, 0, 0),
+    (60 * 60, 10, 30),
+    (6 * 60 * 60, 2 * 60, 5 * 60),
+)
+IDLE_POLL_INTERVAL = 30 * 60
+
+def push_poll_interval(push):
+    """Seconds clients should wait before polling push again."""
+    if push.state not in ('accepting', 'onstage'):
+        return IDLE_POLL_INTERVAL
+    idle = time.time() - query.push_changed(push)
+    for max_idle, onstage, accepting in POLL_INTERVALS:
+        if idle < max_idle:
+            return onstage if push.state == 'onstage' else accepting
+    return IDLE_POLL_INTERVAL
+
+def request_items(requests, user_infos):
+    return cached_request_items('item', requests, lambda request: request_item(request, user_infos))
+
+def request_list(requests, user_infos):
+    return T.ol(class_='requests')(request_items(requests, user_infos))
 
 def take_ownership_form(object):
     form = T.form(class_='small', action=object.uri, method='post')(
@@ -153,7 +243,7 @@ def take_ownership_form(object):
         )
     return form
 
-def new_request_form(push=None, subject='', message='', branch=''):
+def new_request_form(push=None, subject='', message='', branch='', target_date=None):
     label = T.a(class_='toggle', href='#')('New Request') if push else 'New Request'
     class_ = 'push request' if push else 'request'
     content = T.div(class_='content')
@@ -175,7 +265,7 @@ def new_request_form(push=None, subject='', message='', branch=''):
                     ),
                 T.div(
                     T.label(for_='new-request-target-date')('Push Date'),
-                    T.input(name='target_date', id='new-request-target-date', class_='date', value=util.tznow().date().strftime('%Y-%m-%d')),
+                    T.input(name='target_date', id='new-request-target-date', class_='date', value=target_date or util.tznow().date().strftime('%Y-%m-%d')),
                     ),
                 T.div(
                     T.label(for_='new-request-time-to-verify')('Time needed to Verify'),
@@ -288,39 +378,36 @@ jquery_js = script(config.jquery, external=True)
 jquery_ui_js = script(config.jquery_ui, external=True)
 pushmaster_js = script('/js/pushmaster.js')
 
+def dialogs(target_date):
+    request_form = new_request_form(target_date=target_date)
+    request_form(id='new-request-form')
+
+    push_form = new_push_form()
+    push_form(id='new-push-form')
+
+    stage_form = sendtostage_form()
+    stage_form(id='sendtostage-form')
+
+    return T.div(id='dialogs')(request_form, push_form, stage_form, reject_request_form())
+
+# page chrome that is the same on every request, serialized once per process
+static_head = compile_tags(favicon, reset_css, jquery_ui_css, pushmaster_css)
+static_scripts = compile_tags(jquery_js, jquery_ui_js, pushmaster_js)
+static_navbar = compile_tags(navbar())
+static_funcbar = compile_tags(*funcbar().children)
+dialogs_template = compile_tags(dialogs(Hole('target_date')))
+
 class Document(XHTML):
-    def __init__(self, title='pushmaster'):
+    def __init__(self, title='pushmaster', user_infos=None):
         super(Document, self).__init__()
         self.title = T.title(title) if title else T.title()
-        self.head = T.head(
-            meta_content_type, 
-            self.title,
-            favicon,
-            reset_css,
-            jquery_ui_css,
-            pushmaster_css,
-            )
-
-        self.dialogs = T.div(id='dialogs')
-        self.scripts = T.div(jquery_js, jquery_ui_js, pushmaster_js, id='scripts')
-
-        request_form = new_request_form()
-        request_form(id='new-request-form')
-        self.dialogs(request_form)
-
-        push_form = new_push_form()
-        push_form(id='new-push-form')
-        self.dialogs(push_form)
-
-        stage_form = sendtostage_form()
-        stage_form(id='sendtostage-form')
-        self.dialogs(stage_form)
-
-        reject_form = reject_request_form()
-        self.dialogs(reject_form)
-
-        self.funcbar = funcbar()
-        self.body = T.body(session(), navbar(), self.funcbar)
+        self.head = T.head(meta_content_type, self.title, static_head)
+
+        self.dialogs = dialogs_template.render(target_date=util.tznow().date().strftime('%Y-%m-%d'))
+        self.scripts = T.div(static_scripts, id='scripts')
+
+        self.funcbar = T.div(static_funcbar, class_='func')
+        self.body = T.body(session(user_infos or page_user_infos()), static_navbar, self.funcbar)
         self.html(self.head, self.body)
 
     def serialize(self, f):
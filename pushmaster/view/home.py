@@ -3,6 +3,7 @@ import urllib
 
 from google.appengine.api import memcache, users
 
+from pushmaster import cache
 from pushmaster import config
 from pushmaster import model
 from pushmaster import query
@@ -24,8 +25,8 @@ def push_item(push):
         T.span(common.display_push_state(push)),
         )
 
-def request_item(request):
-    item = common.request_item(request)
+def request_item(request, user_infos):
+    item = common.request_item(request, user_infos)
     item(T.span(class_='state')(request.state))
     return item
 
@@ -40,24 +41,25 @@ class Root(RequestHandler):
 class FlushMemcache(RequestHandler):
     def get(self):
         memcache.flush_all()
+        cache.local.clear()
 
 class UserHome(RequestHandler):
     def get(self, email):
         email = urllib.unquote_plus(email)
-
-        doc = common.Document(title='pushmaster: recent activity: ' + email)
-
-        doc.body(T.div(class_='bookmarklet')(common.bookmarklet(self.hostname)))
-
         user = users.User(email)
 
         requests = query.requests_for_user(user)
         pushes = query.pushes_for_user(user)
+        user_infos = common.page_user_infos([request.owner for request in requests])
+
+        doc = common.Document(title='pushmaster: recent activity: ' + email, user_infos=user_infos)
+
+        doc.body(T.div(class_='bookmarklet')(common.bookmarklet(self.hostname)))
 
         if requests:
             doc.body(
                 T.h3('Recent Requests'),
-                T.ol(class_='my requests')(map(request_item, requests)),
+                T.ol(class_='my requests')(common.cached_request_items('home', requests, lambda request: request_item(request, user_infos))),
                 )
 
         if pushes:
@@ -66,7 +68,7 @@ class UserHome(RequestHandler):
                 T.ol(class_='pushes')(map(push_item, pushes)),
                 )
 
-        doc.serialize(self.response.out)
+        self.write_document(doc)
 
 class Favicon(RedirectHandler):
     url = config.favicon
@@ -1,43 +1,55 @@
 import datetime
+import hashlib
 import httplib
 import logging
+import time
 
 from django.utils import simplejson as json
+from google.appengine.api import memcache
 from google.appengine.api import users
 from google.appengine.api.datastore_errors import BadKeyError
 from google.appengine.ext import db
 import yaml
 
-from pushmaster.taglib import T, ScriptCData
-from pushmaster import config, logic, model, query, urls, util
+from pushmaster.taglib import Literal, T, ScriptCData
+from pushmaster import cache, config, context, logic, model, query, urls, util
 from pushmaster.view import common, HTTPStatusCode, RequestHandler
 
 __author__ = 'Jeremy Latt <jlatt@yelp.com>'
-__all__ = ('Pushes', 'EditPush', 'PushJSON')
+__all__ = ('Pushes', 'EditPush', 'PushJSON', 'PushWait')
 
 log = logging.getLogger('pushmaster.view.push')
 
-def push_item(push):
-    requests = query.push_requests(push)
+def push_item(push, requests, user_infos):
     return T.li(class_='push')(
         T.div(
             common.display_datetime(push.ptime),
             T.a(href=push.uri)(push.name or 'push'),
-            common.user_home_link(push.owner, logic.user_info(push.owner)),
+            common.user_home_link(push.owner, user_infos[push.owner]),
             T.span(class_='state')(common.display_push_state(push)),
             class_='headline',
             ),
-        T.ol(map(common.request_item, requests)) if requests else T.div('No requests.'),
+        T.ol(common.request_items(requests, user_infos)) if requests else T.div('No requests.'),
     )
 
-class Pushes(RequestHandler):
-    def get(self):
-        doc = common.Document(title='pushmaster: recent pushes')
+def load_open_pushes():
+    """The open pushes with their requests, and the UserInfos the page needs."""
+    pushes = query.open_pushes()
+    push_requests = [(push, query.push_requests(push)) for push in pushes]
+    owners = [push.owner for push in pushes]
+    for push, requests in push_requests:
+        owners.extend(request.owner for request in requests)
+    return push_requests, common.page_user_infos(owners)
 
-        pushes = query.open_pushes()
+def open_pushes_list(push_requests, user_infos):
+    return T.ol([push_item(push, requests, user_infos) for push, requests in push_requests], class_='requests')
 
-        doc.body(T.h1('Recent Pushes'), T.ol(map(push_item, pushes), class_='requests'))
-        doc.serialize(self.response.out)
+class Pushes(RequestHandler):
+    def get(self):
+        push_requests, user_infos = load_open_pushes()
+        doc = common.Document(title='pushmaster: recent pushes', user_infos=user_infos)
+        doc.body(T.h1('Recent Pushes'), open_pushes_list(push_requests, user_infos))
+        self.write_document(doc)
 
     def post(self):
         action = self.request.get('act')
@@ -49,13 +61,19 @@ class Pushes(RequestHandler):
         else:
             raise HTTPStatusCode(httplib.BAD_REQUEST)
 
-def accepted_list(accepted, request_item=common.request_item, state=''):
-    return T.ol(class_=' '.join(['requests', state]))(map(request_item, accepted))
+def accepted_list(items, state=''):
+    return T.ol(class_=' '.join(['requests', state]))(items)
+
+def push_viewer_role(push):
+    """Fragment role for request items whose actions depend on who owns the push."""
+    current_user = users.get_current_user()
+    is_push_owner = current_user == push.owner
+    return lambda request: '%d%d' % (is_push_owner, current_user == request.owner)
 
-def push_pending_list(push, requests):
+def pending_request_item(push, user_infos):
     is_push_owner = users.get_current_user() == push.owner
     def request_item(request):
-        li = common.request_item(request)
+        li = common.request_item(request, user_infos)
         if is_push_owner:
             li.children.insert(0, T.div(class_='actions')(
                     T.form(class_='small', action=request.uri, method='post')(
@@ -68,10 +86,7 @@ def push_pending_list(push, requests):
                     ),
                )
         return li
-    ol = T.ol(class_='requests')
-    if requests:
-        ol(map(request_item, requests))
-    return ol
+    return request_item
 
 def push_actions_form(push, requests):
     form = T.form(action=push.uri, method='post', class_='small')
@@ -122,6 +137,143 @@ def reject_request_link(request):
     return T.a('Reject', class_='reject-request', href=request.uri, title=request.subject)
 
 
+def push_head(current_user, push, requests, user_infos):
+    head = []
+
+    if current_user == push.owner:
+        head.append(push_actions_form(push, requests)(class_='small push-action'))
+    elif push.can_change_owner:
+        head.append(common.take_ownership_form(push)(class_='small push-action'))
+
+    header = T.h1(common.display_datetime(push.ptime), T.span(class_='name')(push.name or ''), common.user_home_link(push.owner, user_infos[push.owner]))
+
+    if any(request.push_plans for request in requests):
+        header(common.push_plans_badge())
+
+    if any(request.js_serials for request in requests):
+        header(common.js_serials_badge())
+
+    if any(request.img_serials for request in requests):
+        header(common.img_serials_badge())
+
+    head.append(header)
+    return head
+
+def push_lists(current_user, push, requests, user_infos):
+    """The lists of requests in push, in page order.
+
+    Each is (label, state, variant, request_item, role, requests), where
+    variant and role key the cached fragments of its items.
+    """
+    def requests_with_state(state):
+        return filter(lambda r: r.state == state, requests)
+
+    if push.state == 'live':
+        return [(None, 'live', 'item', lambda request: common.request_item(request, user_infos), common.viewer_role, requests_with_state('live'))]
+
+    def onstage_request_item(request):
+        li = common.request_item(request, user_infos)
+        if current_user == push.owner:
+            li.children.insert(0, T.div(class_='actions')(mark_tested_form(request), T.span('or', class_='sep'), withdraw_form(request)))
+        elif current_user == request.owner:
+            li.children.insert(0, T.div(class_='actions')(mark_tested_form(request)))
+        return li
+
+    def withdrawable_request_item(request):
+        li = common.request_item(request, user_infos)
+        if current_user == push.owner:
+            li.children.insert(0, T.div(class_='actions')(withdraw_form(request)))
+        return li
+
+    def accepted_request_item(request):
+        li = common.request_item(request, user_infos)
+        if current_user == push.owner:
+            li.children.insert(0, T.div(class_='actions')(
+                    mark_checked_in_form(request),
+                    T.span('or', class_='sep'),
+                    withdraw_form(request),
+                    T.span('or', class_='sep'),
+                    reject_request_link(request),
+                    ))
+        return li
+
+    request_states = [
+        ('Verified on Stage', 'tested', withdrawable_request_item),
+        ('On Stage (%s)' % push.stage, 'onstage', onstage_request_item),
+        ('Checked In', 'checkedin', withdrawable_request_item),
+        ('Accepted', 'accepted', accepted_request_item),
+        ]
+    role = push_viewer_role(push)
+    lists = []
+    for label, state, request_item in request_states:
+        subrequests = requests_with_state(state)
+        if subrequests:
+            if len(subrequests) > 5:
+                label = '%(label)s (%(count)d)' % {'label': label, 'count': len(subrequests)}
+            requestors = ', '.join(set(request.owner.nickname() for request in subrequests))
+            label = '%(label)s - %(requestors)s' % {'label': label, 'requestors': requestors}
+            lists.append((label, state, request_item.__name__, request_item, role, subrequests))
+    return lists
+
+def cherry_pick_code(current_user, push, requests):
+    if current_user == push.owner:
+        accepted_requests = filter(lambda r: r.state == 'accepted', requests)
+        if accepted_requests:
+            return 'cherry-pick-branches %s' % (' '.join(['"%s"' % request.branch for request in accepted_requests if request.branch]),)
+    return None
+
+def pending_list(push, pending_requests, user_infos):
+    """(label, variant, request_item, role) for push's pending requests, or None."""
+    if push.editable and pending_requests:
+        label = ('Pending Requests (%d)' % len(pending_requests)) if len(pending_requests) > 5 else 'Pending Requests'
+        # the accept form names the push
+        return label, 'pending-%s' % push.key(), pending_request_item(push, user_infos), push_viewer_role(push)
+    return None
+
+def push_payload(current_user, push, requests, pending_requests, user_infos, have):
+    """The push page as lists of item ids, for clients that patch it in place.
+
+    Only the HTML of items whose ids are not in have is included.
+    """
+    rows = {}
+    def item_ids(variant, subrequests, request_item, role):
+        names = common.fragment_names(variant, subrequests, role)
+        missing = [(request, name) for request, name in zip(subrequests, names) if common.fragment_id(name) not in have]
+        if missing:
+            missing_requests, missing_names = zip(*missing)
+            for name, html in zip(missing_names, common.request_fragments(missing_requests, missing_names, request_item)):
+                rows[common.fragment_id(name)] = html
+        return map(common.fragment_id, names)
+
+    lists = []
+    for label, state, variant, request_item, role, subrequests in push_lists(current_user, push, requests, user_infos):
+        lists.append({'label': label, 'state': state, 'rows': item_ids(variant, subrequests, request_item, role)})
+
+    pending = pending_list(push, pending_requests, user_infos)
+    if pending:
+        label, variant, request_item, role = pending
+        pending = {'label': label, 'rows': item_ids(variant, pending_requests, request_item, role)}
+
+    return {
+        'push': dict(key=unicode(push.key()), state=push.state, stage=push.stage),
+        'head': u''.join(map(unicode, push_head(current_user, push, requests, user_infos))),
+        'lists': lists,
+        'code': cherry_pick_code(current_user, push, requests),
+        'pending': pending,
+        'rows': rows,
+        }
+
+
+PUSH_HTML_SECONDS = 60 * 60
+PUSH_HTML_STAT = 'push-html'
+
+def push_html_role(current_user, push, requests):
+    if current_user == push.owner:
+        return 'pushmaster'
+    if any(request.owner == current_user for request in requests):
+        return 'owner:' + current_user.email()
+    return 'other'
+
 class PushCommon(RequestHandler):
     def get(self, push_id):
         push = None
@@ -132,121 +284,101 @@ class PushCommon(RequestHandler):
             return
 
         try:
-            push = model.Push.get(push_id)
+            push = query.get_push(push_id)
         except BadKeyError:
             raise HTTPStatusCode(httplib.NOT_FOUND)
 
         current_user = users.get_current_user()
-        pending_requests = query.pending_requests(not_after=util.tznow().date()) if current_user == push.owner else []
-        self.render(push, current_user, pending_requests)
-
-    def get_request_header_list(self, header, default=''):
-        hval = self.request.headers.get(header, default)
-        return [part.strip() for part in hval.split(',')]
-
-    def render_push_div(self, current_user, push, requests, pending_requests):
-        push_div = T.div(class_='push')
-
-        if current_user == push.owner:
-            push_div(push_actions_form(push, requests)(class_='small push-action'))
-        elif push.can_change_owner:
-            push_div(common.take_ownership_form(push)(class_='small push-action'))
-
-        header = T.h1(common.display_datetime(push.ptime), T.span(class_='name')(push.name or ''), common.user_home_link(push.owner, logic.user_info(push.owner)))
-
-        if any(request.push_plans for request in requests):
-            header(common.push_plans_badge())
-
-        if any(request.js_serials for request in requests):
-            header(common.js_serials_badge())
-
-        if any(request.img_serials for request in requests):
-            header(common.img_serials_badge())
+        etag = common.push_etag(push, current_user)
+        if self.check_etag(push, etag):
+            return
 
-        push_div(header)
+        requests = query.push_requests(push)
+        self.render(current_user, push, requests, etag)
+
+    def check_etag(self, push, etag):
+        return False
+
+    def push_html(self, current_user, push, requests, user_infos=None):
+        """The rendered push div, shared by every viewer in the same role.
+
+        Only the first viewer after a change renders it; the rest wait on its
+        lease and read the result from cache. The UserInfos loaded to render
+        it are added to user_infos.
+        """
+        role = push_html_role(current_user, push, requests)
+        today = util.tznow().date()
+        version = [
+            push.mtime.isoformat(),
+            common.FRAGMENT_APP_VERSION,
+            cache.stamp(push.cache_namespace),
+            # full names in the div
+            cache.stamp(model.FRAGMENT_CACHE_NAMESPACE),
+            today.isoformat(),
+            ]
+        if role == 'pushmaster':
+            # the pushmaster also sees the pending requests
+            version.append(cache.stamp(query.REQUEST_CACHE_NAMESPACE))
+        name = 'push-html-' + hashlib.md5(repr((role, version))).hexdigest()
+
+        rendered = []
+        def render():
+            rendered.append(True)
+            pending_requests = query.pending_requests(not_after=today) if role == 'pushmaster' else []
+            page_user_infos = common.page_user_infos([push.owner], [request.owner for request in requests + pending_requests])
+            if user_infos is not None:
+                user_infos.update(page_user_infos)
+            return unicode(self.render_push_div(current_user, push, requests, pending_requests, page_user_infos))
+
+        html = cache.get_or_compute(push.cache_namespace, name, render, PUSH_HTML_SECONDS, stat=PUSH_HTML_STAT, stale=False)
+        cache.count('fragment.push.miss' if rendered else 'fragment.push.hit')
+        return Literal(html)
+
+    def render_push_div(self, current_user, push, requests, pending_requests, user_infos):
+        push_div = T.div(class_='push')(push_head(current_user, push, requests, user_infos))
         requests_div = T.div(class_='requests')
         push_div(requests_div)
 
-        def requests_with_state(state):
-            return filter(lambda r: r.state == state, requests)
+        for label, state, variant, request_item, role, subrequests in push_lists(current_user, push, requests, user_infos):
+            if label:
+                requests_div(T.h3(label))
+            requests_div(accepted_list(common.cached_request_items(variant, subrequests, request_item, role), state=state))
 
-        if push.state == 'live':
-            requests_div(accepted_list(requests_with_state('live'), state='live'))
-        else:
-            def onstage_request_item(request):
-                li = common.request_item(request)
-                if current_user == push.owner:
-                    li.children.insert(0, T.div(class_='actions')(mark_tested_form(request), T.span('or', class_='sep'), withdraw_form(request)))
-                elif current_user == request.owner:
-                    li.children.insert(0, T.div(class_='actions')(mark_tested_form(request)))
-                return li
-
-            def withdrawable_request_item(request):
-                li = common.request_item(request)
-                if current_user == push.owner:
-                    li.children.insert(0, T.div(class_='actions')(withdraw_form(request)))
-                return li
-
-            def accepted_request_item(request):
-                li = common.request_item(request)
-                if current_user == push.owner:
-                    li.children.insert(0, T.div(class_='actions')(
-                            mark_checked_in_form(request),
-                            T.span('or', class_='sep'),
-                            withdraw_form(request),
-                            T.span('or', class_='sep'),
-                            reject_request_link(request),
-                            ))
-                return li
-
-            request_states = [
-                ('Verified on Stage', 'tested', withdrawable_request_item),
-                ('On Stage (%s)' % push.stage, 'onstage', onstage_request_item),
-                ('Checked In', 'checkedin', withdrawable_request_item),
-                ('Accepted', 'accepted', accepted_request_item),
-                ]
-            for label, state, request_item in request_states:
-                subrequests = requests_with_state(state)
-                if subrequests:
-                    if len(subrequests) > 5:
-                        label = '%(label)s (%(count)d)' % {'label': label, 'count': len(subrequests)}
-                    requestors = ', '.join(set(request.owner.nickname() for request in subrequests))
-                    label = '%(label)s - %(requestors)s' % {'label': label, 'requestors': requestors}
-                    requests_div(T.h3(label), accepted_list(subrequests, request_item=request_item, state=state))
+        code = cherry_pick_code(current_user, push, requests)
+        if code:
+            requests_div(T.div(code, class_='code'))
 
-        if current_user == push.owner:
-            accepted_requests = requests_with_state('accepted')
-            if accepted_requests:
-                requests_div(T.div('cherry-pick-branches %s' % (' '.join(['"%s"' % request.branch for request in accepted_requests if request.branch]),), class_='code'))
-
-        if push.editable:
-            if pending_requests:
-                pending_requests_title = ('Pending Requests (%d)' % len(pending_requests)) if len(pending_requests) > 5 else 'Pending Requests'
-                push_div(T.h2(class_='pending')(pending_requests_title), push_pending_list(push, pending_requests))
+        pending = pending_list(push, pending_requests, user_infos)
+        if pending:
+            label, variant, request_item, role = pending
+            push_div(T.h2(class_='pending')(label), T.ol(class_='requests')(common.cached_request_items(variant, pending_requests, request_item, role)))
 
         return push_div
 
 
 class EditPush(PushCommon):
-    def render(self, push, current_user, pending_requests):
-        doc = self.render_doc(push, current_user, pending_requests)
-        doc.serialize(self.response.out)
-
-    def render_doc(self, push, current_user, pending_requests):
-        doc = common.Document(title='pushmaster: push: %s %s' % (util.format_datetime(push.ptime), push.name))
+    def render(self, current_user, push, requests, etag):
+        # filled only when this request renders the div; otherwise the page
+        # loads just the viewer's UserInfo
+        user_infos = {}
+        push_html = self.push_html(current_user, push, requests, user_infos)
+        doc = self.render_doc(push, push_html, etag, user_infos or None)
+        self.write_document(doc)
+
+    def render_doc(self, push, push_html, etag, user_infos=None):
+        doc = common.Document(title='pushmaster: push: %s %s' % (util.format_datetime(push.ptime), push.name), user_infos=user_infos)
         doc.funcbar(T.span('|', class_='sep'), common.push_email(push, 'Send Mail to Requesters'))
 
-        requests = query.push_requests(push)
-        push_div = self.render_push_div(current_user, push, requests, pending_requests)
-        doc.body(push_div)
+        doc.body(push_html)
 
         doc.scripts(common.script('/js/push.js'))
-        push_json = ScriptCData('this.push = %s;' % json.dumps(dict(key=str(push.key()), state=push.state)))
+        push_json = ScriptCData('this.push = %s;' % json.dumps(dict(key=str(push.key()), state=push.state, etag=etag, poll_interval=common.push_poll_interval(push))))
         doc.head(T.script(type='text/javascript')(push_json))
 
         return doc
 
     def post(self, push_id):
+        # writes start from the datastore, never from a cached copy
         try:
             push = model.Push.get(push_id)
         except BadKeyError:
@@ -276,11 +408,97 @@ class EditPush(PushCommon):
 
 
 class PushJSON(PushCommon):
-    def render(self, push, current_user, pending_requests):
-        requests = query.push_requests(push)
-        push_div = self.render_push_div(current_user, push, requests, pending_requests)
-        response = {'push': dict(key=unicode(push.key()), state=push.state), 'html': unicode(push_div)}
+    min_poll_interval = 0
+
+    def check_etag(self, push, etag):
+        # the client revalidates with If-None-Match itself
+        self.response.headers['Cache-Control'] = 'no-store'
+        self.poll_interval = max(common.push_poll_interval(push), self.min_poll_interval)
+        self.response.headers['X-Poll-Interval'] = str(self.poll_interval)
+        return self.not_modified(etag)
+
+    def render(self, current_user, push, requests, etag):
+        # ids of the items the page already shows, which need no HTML
+        have = set(filter(None, self.request.get('have').split(',')))
+        pending_requests = query.pending_requests(not_after=util.tznow().date()) if current_user == push.owner else []
+        user_infos = common.page_user_infos([push.owner], [request.owner for request in requests + pending_requests])
+        response = push_payload(current_user, push, requests, pending_requests, user_infos, have)
+        response['poll_interval'] = self.poll_interval
         self.response.headers['Vary'] = 'Accept'
         self.response.headers['Content-Type'] = 'application/json'
-        self.response.headers['Cache-Control'] = 'no-store'
         json.dump(response, self.response.out)
+
+
+LONG_POLL_SECONDS = 20
+LONG_POLL_FIRST_DELAY = 0.1
+LONG_POLL_MAX_DELAY = 1.0
+# the python runtime serves one request per instance, so every waiter holds a
+# whole instance; beyond this many per push, polls are answered at once
+LONG_POLL_MAX_WAITERS = 3
+LONG_POLL_WAITERS_KEY = 'long-poll-waiters-%s'
+# the counters expire now and then so waiters lost to hard deadlines can't leak
+LONG_POLL_WAITERS_SECONDS = 5 * 60
+# what pages that could not wait poll at instead, the old fixed poll interval
+GATED_POLL_INTERVAL = 30
+
+class PushWait(PushJSON):
+    """Hold a poll until the push changes, then answer like PushJSON.
+
+    The client sends the ETag of what it shows. Versions are checked in
+    memcache with a backoff of up to a second; after LONG_POLL_SECONDS with
+    no change the answer is 304 Not Modified. Only LONG_POLL_MAX_WAITERS
+    polls of each push wait at a time; the rest are answered like PushJSON,
+    with a poll interval of at least GATED_POLL_INTERVAL.
+    """
+
+    def get(self, push_id):
+        waiters_key = LONG_POLL_WAITERS_KEY % push_id
+        memcache.add(waiters_key, 0, LONG_POLL_WAITERS_SECONDS)
+        waiters = memcache.incr(waiters_key)
+        if waiters is None or waiters > LONG_POLL_MAX_WAITERS:
+            if waiters is not None:
+                memcache.decr(waiters_key)
+            cache.count('long-poll.gated')
+            self.min_poll_interval = GATED_POLL_INTERVAL
+            return super(PushWait, self).get(push_id)
+
+        try:
+            cache.count('long-poll.wait')
+            self.wait(push_id)
+        finally:
+            memcache.decr(waiters_key)
+
+    def wait(self, push_id):
+        try:
+            push = query.get_push(push_id)
+        except BadKeyError:
+            raise HTTPStatusCode(httplib.NOT_FOUND)
+
+        self.response.headers['Cache-Control'] = 'no-store'
+        current_user = users.get_current_user()
+        client_etags = self.get_request_header_list('If-None-Match')
+
+        etag = common.push_etag(push, current_user)
+        deadline = time.time() + LONG_POLL_SECONDS
+        delay = LONG_POLL_FIRST_DELAY
+        while etag in client_etags:
+            if time.time() + delay > deadline:
+                self.response.headers['X-Poll-Interval'] = str(common.push_poll_interval(push))
+                self.not_modified(etag)
+                return
+            time.sleep(delay)
+            delay = min(delay * 2, LONG_POLL_MAX_DELAY)
+            cache.refresh(*common.push_etag_namespaces(push))
+            etag = common.push_etag(push, current_user)
+
+        # something changed since this request started, so drop what it read
+        context.forget()
+        cache.refresh(model.ENTITY_CACHE_NAMESPACE)
+        push = query.get_push(push_id)
+        etag = common.push_etag(push, current_user)
+        self.response.headers['ETag'] = etag
+        self.poll_interval = common.push_poll_interval(push)
+        self.response.headers['X-Poll-Interval'] = str(self.poll_interval)
+
+        requests = query.push_requests(push)
+        self.render(current_user, push, requests, etag)
@@ -1,10 +1,11 @@
-import datetime, httplib, logging
+import datetime, hashlib, httplib, logging, random
 
+from django.utils import simplejson as json
 from google.appengine.api import users
 
-from pushmaster import config, model, query, timezone, urls, logic
-from pushmaster.view import common, RequestHandler
-from pushmaster.taglib import T
+from pushmaster import config, model, query, timezone, urls, util
+from pushmaster.view import common, HTTPStatusCode, RequestHandler
+from pushmaster.taglib import Literal, T
 
 def report_date_range(datestr):
     from_date = datetime.datetime.strptime(datestr, '%Y%m%d').replace(tzinfo=config.tzinfo)
@@ -15,6 +16,96 @@ def last_monday_datetime(from_date=None):
     from_date = from_date or datetime.date.today()
     return from_date - datetime.timedelta(days=from_date.weekday())
 
+def report_user(nickname):
+    return users.User('@'.join([nickname, config.mail_domain]))
+
+def load_week_report(from_date):
+    """Load everything the report for a week shows in a handful of batches.
+
+    Returns the roster index, the week's live requests grouped by owner
+    nickname and the UserInfo of every request owner.
+    """
+    pushes = query.pushes_for_the_week_of(from_date)
+    requests = sorted(query.requests_for_pushes(pushes), key=lambda r: r.mtime)
+
+    requests_by_dev = {}
+    for request in requests:
+        requests_by_dev.setdefault(request.owner.nickname(), []).append(request)
+
+    user_infos = common.page_user_infos([request.owner for request in requests])
+
+    return query.roster_index(), requests_by_dev, user_infos
+
+def teams_list(roster, requests_by_dev, user_infos, snapshot=False):
+    names = roster['names']
+    teams_list = T.ul(class_='teams')
+
+    nothing_messages_list = None
+
+    for (team_name, team) in sorted(roster['teams'].iteritems()):
+        team_item = T.li(class_='team')(T.h3(team_name))
+        teams_list(team_item)
+
+        devs_list = T.ul(class_='devs')
+        team_item(devs_list)
+        for dev in team.get('dev', ()):
+            dev_item = T.li(class_='dev')(T.h4(names[dev]))
+            devs_list(dev_item)
+            dev_requests = requests_by_dev.get(dev)
+            if dev_requests:
+                if snapshot:
+                    requests_list = T.ol(class_='requests')([common.request_item(request, user_infos, snapshot=True) for request in dev_requests])
+                else:
+                    requests_list = common.request_list(dev_requests, user_infos)
+                dev_item(requests_list)
+            else:
+                # lazy (re)initialize random messages
+                if not nothing_messages_list:
+                    nothing_messages_list = list(config.nothing_messages)
+                    random.shuffle(nothing_messages_list)
+
+                dev_item(T.div(nothing_messages_list.pop(), class_='nothing'))
+
+        if 'prod' in team:
+            pm_title ='PM: ' if len(team['prod']) == 1 else 'PMs: '
+            pm_names = ', '.join([names[pm] for pm in team['prod']])
+            team_item(T.h4(pm_title, pm_names, class_='pm'))
+
+    return teams_list
+
+def week_is_over(from_date):
+    return util.tznow() >= from_date + datetime.timedelta(days=7)
+
+def build_week_report(datestr):
+    """Render the report for the week starting on datestr and store it.
+
+    Only the report task calls this, and the snapshot it stores is the same
+    for every viewer.
+    """
+    from_date, to_date = report_date_range(datestr)
+    roster, requests_by_dev, user_infos = load_week_report(from_date)
+
+    html = unicode(teams_list(roster, requests_by_dev, user_infos, snapshot=True))
+    names = roster['names']
+    data = {}
+    for team_name, team in roster['teams'].iteritems():
+        data[team_name] = {
+            'devs': [{'nickname': dev, 'name': names[dev], 'requests': [str(request.key()) for request in requests_by_dev.get(dev, ())]} for dev in team.get('dev', ())],
+            'pms': [names[pm] for pm in team.get('prod', ())],
+            }
+
+    report = model.WeeklyReport(
+        key_name=datestr,
+        html=html,
+        data=json.dumps({'teams': data}),
+        etag=hashlib.md5(html.encode('utf-8')).hexdigest(),
+        complete=week_is_over(from_date),
+        version=model.WEEKLY_REPORT_VERSION,
+        )
+    report.put()
+
+    return report
+
 class LastWeek(RequestHandler):
     def get(self, datestr=None):
         if datestr:
@@ -23,46 +114,99 @@ class LastWeek(RequestHandler):
             for_date = last_monday_datetime() - datetime.timedelta(days=7)
             return self.redirect('/lastweek/' + for_date.strftime('%Y%m%d'))
 
-        pushes = query.pushes_for_the_week_of(from_date)
-        requests = []
-        for push in pushes:
-            requests.extend(query.push_requests(push))
-        requests = sorted(requests, key=lambda r: r.mtime)
-
-        doc = common.Document(title='pushmaster: weekly report: ' + datestr)
-
-        teams_list = T.ul(class_='teams')
-        doc(teams_list)
-
-        nothing_messages_list = None
-
-        report_users = query.report_users_by_team()
-        for (team_name, team) in sorted(report_users.iteritems()):
-            team_item = T.li(class_='team')(T.h3(team_name))
-            teams_list(team_item)
-
-            devs_list = T.ul(class_='devs')
-            team_item(devs_list)
-            for dev in sorted(team['dev']):
-                dev_item = T.li(class_='dev')(T.h4(logic.user_info(users.User('@'.join([dev, config.mail_domain]))).full_name))
-                devs_list(dev_item)
-                dev_requests = filter(lambda r: r.owner.nickname() == dev, requests)
-                if dev_requests:
-                    requests_list = T.ol(class_='requests')(map(common.request_item, dev_requests))
-                    dev_item(requests_list)
-                else:
-                    # lazy (re)initialize random messages
-                    if not nothing_messages_list:
-                        nothing_messages_list = list(config.nothing_messages)
-                        import random
-                        random.shuffle(nothing_messages_list)
+        report = model.WeeklyReport.get_by_key_name(datestr)
+        week_over = week_is_over(from_date)
+        if report is None or report.version != model.WEEKLY_REPORT_VERSION or (not report.complete and week_over):
+            # snapshots are only built by the report task; naming it after
+            # the snapshot it builds keeps page views from queueing duplicates
+            task_name = 'weekly-report-%s-v%d-%s' % (datestr, model.WEEKLY_REPORT_VERSION, 'complete' if week_over else 'partial')
+            util.queue_week_report(from_date, name=task_name)
+        if report is None:
+            self.response.headers['Cache-Control'] = 'private, max-age=0, must-revalidate'
+            roster, requests_by_dev, user_infos = load_week_report(from_date)
+            doc = common.Document(title='pushmaster: weekly report: ' + datestr, user_infos=user_infos)
+            doc.body(teams_list(roster, requests_by_dev, user_infos))
+            self.write_document(doc)
+            return
+
+        # the snapshot never changes once current, but the page chrome names
+        # the viewer and defaults the new request form to today, so the tag
+        # covers those and browsers revalidate every time
+        current_user = users.get_current_user()
+        user_infos = common.page_user_infos()
+        chrome = [current_user.email(), user_infos[current_user].full_name, util.tznow().date().isoformat()]
+        etag = '"%s-%s"' % (report.etag, hashlib.md5(repr(chrome)).hexdigest()[:8])
+        self.response.headers['Cache-Control'] = 'private, max-age=0, must-revalidate'
+
+        if self.not_modified(etag):
+            return
+
+        doc = common.Document(title='pushmaster: weekly report: ' + datestr, user_infos=user_infos)
+        doc.body(Literal(report.html))
+        self.write_document(doc)
+
+# two years of weeks fetched in one batch get is plenty for one page
+MAX_RANGE_WEEKS = 106
+
+def add_counts(into, counts):
+    for name, n in counts.iteritems():
+        into[name] = into.get(name, 0) + n
+
+def merge_week_aggregates(datestrs, aggregates):
+    """Total up a run of weeks, keeping a per-week breakdown."""
+    totals = {'pushes': 0, 'requests': 0, 'devs': {}, 'teams': {}, 'states': {}}
+    weeks = []
+    for datestr, aggregate in zip(datestrs, aggregates):
+        week = {'week': datestr, 'pushes': 0, 'requests': 0}
+        if aggregate is not None:
+            for push_totals in aggregate.get_pushes().itervalues():
+                week['pushes'] += 1
+                week['requests'] += push_totals['requests']
+                for counts in ('devs', 'teams', 'states'):
+                    add_counts(totals[counts], push_totals[counts])
+        totals['pushes'] += week['pushes']
+        totals['requests'] += week['requests']
+        weeks.append(week)
+    totals['weeks'] = weeks
+    return totals
+
+def counts_list(counts, name=lambda key: key, class_=None):
+    ordered = sorted(counts.iteritems(), key=lambda (key, n): (-n, key))
+    return T.table(class_=class_)([T.tr(T.td(name(key)), T.td(str(n))) for key, n in ordered])
+
+class DateRangeCommon(RequestHandler):
+    def get(self, from_datestr, to_datestr):
+        try:
+            from_date = report_date_range(from_datestr)[0]
+            to_date = report_date_range(to_datestr)[0]
+        except ValueError:
+            raise HTTPStatusCode(httplib.BAD_REQUEST)
+
+        datestrs = util.week_datestrs(from_date, to_date)
+        if not datestrs or len(datestrs) > MAX_RANGE_WEEKS:
+            raise HTTPStatusCode(httplib.BAD_REQUEST)
+
+        totals = merge_week_aggregates(datestrs, query.week_aggregates(datestrs))
+        self.render(from_datestr, to_datestr, totals)
 
-                    dev_item(T.div(nothing_messages_list.pop(), class_='nothing'))
+class DateRange(DateRangeCommon):
+    def render(self, from_datestr, to_datestr, totals):
+        user_infos = common.page_user_infos(map(report_user, totals['devs']))
+        full_name = lambda nickname: user_infos[report_user(nickname)].full_name
 
+        doc = common.Document(title='pushmaster: report: %s to %s' % (from_datestr, to_datestr), user_infos=user_infos)
+        doc.body(T.h2('%d requests in %d pushes' % (totals['requests'], totals['pushes'])))
+        doc.body(T.table(class_='weeks')(
+                T.tr(T.th('week'), T.th('pushes'), T.th('requests')),
+                [T.tr(T.td(T.a(week['week'], href='/lastweek/' + week['week'])), T.td(str(week['pushes'])), T.td(str(week['requests']))) for week in totals['weeks']],
+                ))
+        doc.body(T.h3('teams'), counts_list(totals['teams'], class_='teams'))
+        doc.body(T.h3('devs'), counts_list(totals['devs'], name=full_name, class_='devs'))
+        doc.body(T.h3('states'), counts_list(totals['states'], class_='states'))
+        self.write_document(doc)
 
-            if 'prod' in team:
-                pm_title ='PM: ' if len(team['prod']) == 1 else 'PMs: '
-                pm_names = ', '.join([logic.user_info(users.User('@'.join([pm, config.mail_domain]))).full_name for pm in team['prod']])
-                team_item(T.h4(pm_title, pm_names, class_='pm'))
-        
-        doc.serialize(self.response.out)
+class DateRangeJSON(DateRangeCommon):
+    def render(self, from_datestr, to_datestr, totals):
+        totals.update({'from': from_datestr, 'to': to_datestr})
+        self.response.headers['Content-Type'] = 'application/json'
+        json.dump(totals, self.response.out)
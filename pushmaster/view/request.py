@@ -10,7 +10,7 @@ from pushmaster import logic
 from pushmaster import query
 from pushmaster import util
 from pushmaster.model import *
-from pushmaster.taglib import T
+from pushmaster.taglib import Hole, T, Template
 from pushmaster.view import common
 from pushmaster.view import HTTPStatusCode
 from pushmaster.view import RequestHandler
@@ -18,49 +18,49 @@ from pushmaster.view import RequestHandler
 __author__ = 'Jeremy Latt <jlatt@yelp.com>'
 __all__ = ('Requests', 'EditRequest')
 
-def edit_request_form(request):
-    request_id = str(request.key())
-    return T.form(action=request.uri, method='post', class_='edit request')(
+def edit_request_form_tags():
+    request_id = unicode(Hole('id'))
+    return T.form(action=Hole('uri'), method='post', class_='edit request')(
         T.fieldset(class_='container')(
             T.legend(T.a(class_='toggle', href='#')('Edit Request')),
             T.div(class_='content')(
                 T.div(
                     T.label(for_='edit-request-subject-'+request_id)('Subject'),
-                    T.input(name='subject', id='edit-request-subject-'+request_id, value=request.subject),
+                    T.input(name='subject', id='edit-request-subject-'+request_id, value=Hole('subject')),
                     ),
                 T.div(
                     T.label(for_='edit-request-branch-'+request_id)('Branch'),
-                    T.input(name='branch', id='edit-request-branch-'+request_id, value=request.branch or ''),
+                    T.input(name='branch', id='edit-request-branch-'+request_id, value=Hole('branch')),
                     ),
                 T.div(
                     T.label(for_='edit-request-message-'+request_id)('Message'),
-                    T.textarea(name='message', id='edit-request-message-'+request_id)(request.message or ''),
+                    T.textarea(name='message', id='edit-request-message-'+request_id)(Hole('message')),
                     ),
                 T.div(
                     T.label(for_='edit-request-target-date-'+request_id)('Push Date'),
-                    T.input(name='target_date', id='edit-request-target-date-'+request_id, class_='date', value=request.target_date.strftime('%Y-%m-%d') if request.target_date else ''),
+                    T.input(name='target_date', id='edit-request-target-date-'+request_id, class_='date', value=Hole('target_date')),
                     ),
                 T.div(
                     T.label(for_='edit-request-time-to-verify-'+request_id)('Time needed to Verify'),
-                    T.input(name='time_to_verify', id='edit-request-time-to-verify-'+request_id, value=request.time_to_verify),
+                    T.input(name='time_to_verify', id='edit-request-time-to-verify-'+request_id, value=Hole('time_to_verify')),
                     ),
                 T.fieldset(class_='flags')(
                     T.legend('Flags'),
                     T.div(
-                        T.input(id='edit-request-urgent-'+request_id, type='checkbox', name='urgent', class_='checkbox', checked=request.urgent),
+                        T.input(id='edit-request-urgent-'+request_id, type='checkbox', name='urgent', class_='checkbox', checked=Hole('urgent')),
                         T.label(for_='edit-request-urgent-'+request_id, class_='checkbox')('Urgent (e.g. P0)'),
                         ),
                     T.div(
-                        T.input(id='edit-request-tests-pass-'+request_id, type='checkbox', name='tests_pass', checked=request.tests_pass, class_='checkbox'),
+                        T.input(id='edit-request-tests-pass-'+request_id, type='checkbox', name='tests_pass', checked=Hole('tests_pass'), class_='checkbox'),
                         T.label(for_='edit-request-tests-pass-'+request_id, class_='checkbox')('Passes Buildbot'),
-                        T.input(id='edit-request-tests-pass-url-'+request_id, name='tests_pass_url', class_='tests-pass-url', value=request.tests_pass_url),
+                        T.input(id='edit-request-tests-pass-url-'+request_id, name='tests_pass_url', class_='tests-pass-url', value=Hole('tests_pass_url')),
                         ),
                     T.div(
-                        T.input(id='edit-request-push-plans-'+request_id, type='checkbox', name='push_plans', checked=request.push_plans, class_='checkbox'),
+                        T.input(id='edit-request-push-plans-'+request_id, type='checkbox', name='push_plans', checked=Hole('push_plans'), class_='checkbox'),
                         T.label(for_='edit-request-push-plans-'+request_id, class_='checkbox')('Push Plans'),
                         ),
                     T.div(
-                        T.input(id='edit-request-img-serials-'+request_id, type='checkbox', name='img_serials', checked=request.img_serials, class_='checkbox'),
+                        T.input(id='edit-request-img-serials-'+request_id, type='checkbox', name='img_serials', checked=Hole('img_serials'), class_='checkbox'),
                         T.label(for_='edit-request-img-serials-'+request_id, class_='checkbox')('Bump Image Serials'),
                         ),
                     ),
@@ -71,6 +71,24 @@ def edit_request_form(request):
             ),
         )
 
+edit_request_template = Template(edit_request_form_tags())
+
+def edit_request_form(request):
+    return edit_request_template.render(
+        id=str(request.key()),
+        uri=request.uri,
+        subject=request.subject,
+        branch=request.branch,
+        message=request.message,
+        target_date=request.target_date.strftime('%Y-%m-%d') if request.target_date else None,
+        time_to_verify=request.time_to_verify,
+        urgent=request.urgent,
+        tests_pass=request.tests_pass,
+        tests_pass_url=request.tests_pass_url,
+        push_plans=request.push_plans,
+        img_serials=request.img_serials,
+        )
+
 def request_actions_form(request):
     form = T.form(action=request.uri, method='post', class_='request-actions')
 
@@ -79,10 +97,10 @@ def request_actions_form(request):
 
     return form
 
-def request_display(request, push):
+def request_display(request, push, user_infos):
     title = T.h2(class_='request-title')(
         T.span(class_='subject')(request.subject),
-        common.user_home_link(request.owner, logic.user_info(request.owner)),
+        common.user_home_link(request.owner, user_infos[request.owner]),
         common.display_date(request.target_date),
         )
     div = T.div(class_='request')(title)
@@ -103,7 +121,7 @@ def request_display(request, push):
             T.p(common.linkify(request.reject_reason), class_='reject-reason'),
             )
 
-    div(T.div(class_='message')(common.linkify(request.message or '')))
+    div(T.div(class_='message')(common.message_html(request)))
 
     if request.urgent:
         title.attrs['class'] += ' urgent'
@@ -117,17 +135,19 @@ def request_display(request, push):
 
     return div
 
+def current_requests_section(requests, user_infos):
+    return [
+        T.h2(('Current Requests (%d)' % len(requests)) if len(requests) > 5 else 'Current Requests'),
+        common.request_list(requests, user_infos) if requests else T.span('There are no requests at present.'),
+        ]
+
 class Requests(RequestHandler):
     def get(self):
         requests = query.current_requests()
-
-        doc = common.Document(title='pushmaster: requests')
-        doc.body(
-            T.h2(('Current Requests (%d)' % len(requests)) if len(requests) > 5 else 'Current Requests'),
-            common.request_list(requests) if requests else T.span('There are no requests at present.'),
-            T.div(common.bookmarklet(self.hostname)),
-            )
-        doc.serialize(self.response.out)
+        user_infos = common.page_user_infos([request.owner for request in requests])
+        doc = common.Document(title='pushmaster: requests', user_infos=user_infos)
+        doc.body(current_requests_section(requests, user_infos), T.div(common.bookmarklet(self.hostname)))
+        self.write_document(doc)
 
     def post(self):
         subject = self.request.get('subject')
@@ -172,7 +192,7 @@ class Requests(RequestHandler):
         push_key = self.request.get('push')
         if push_key:
             try:
-                push = Push.get(push_key)
+                push = query.get_push(push_key)
             except BadKeyError:
                 pass
         self.redirect(push.uri if push else request.uri)
@@ -180,14 +200,15 @@ class Requests(RequestHandler):
 class EditRequest(RequestHandler):
     def get(self, request_id):
         try:
-            request = Request.get(request_id)
+            request = query.get_request(request_id)
         except BadKeyError:
             raise HTTPStatusCode(httplib.NOT_FOUND)
 
-        doc = common.Document(title='pushmaster: request: ' + request.subject)
+        user_infos = common.page_user_infos([request.owner])
+        doc = common.Document(title='pushmaster: request: ' + request.subject, user_infos=user_infos)
 
-        push = request.push
-        rdisplay = request_display(request, push)
+        push = query.request_push(request)
+        rdisplay = request_display(request, push, user_infos)
         doc.body(rdisplay)
 
         if request.owner == users.get_current_user():
@@ -196,9 +217,10 @@ class EditRequest(RequestHandler):
         elif request.can_change_owner:
             rdisplay(common.take_ownership_form(request))
 
-        doc.serialize(self.response.out)
+        self.write_document(doc)
 
     def post(self, request_id):
+        # writes start from the datastore, never from a cached copy
         try:
             request = Request.get(request_id)
         except BadKeyError:
@@ -1,27 +1,106 @@
 pushmaster.provide('push');
 
-pushmaster.push.pageReloadDelay = 30 * 1000; // ms
+pushmaster.push.minRetryDelay = 30 * 1000; // ms
+pushmaster.push.maxRetryDelay = 30 * 60 * 1000; // ms
+pushmaster.push.retryDelay = pushmaster.push.minRetryDelay;
+pushmaster.push.waitTimeout = 40 * 1000; // ms, comfortably over the server's hold
 
-pushmaster.push.retrievePushData = function() {
+// spread polls from pages opened together by up to a fifth either way
+pushmaster.push.jitter = function(delay) {
+    return Math.round(delay * (0.8 + 0.4 * Math.random()));
+};
+
+// the server's X-Poll-Interval in ms, falling back to what it said before
+pushmaster.push.pollDelay = function(xhr) {
+    var interval = parseInt(xhr.getResponseHeader('X-Poll-Interval'), 10);
+    if (!isNaN(interval)) {
+        push.poll_interval = interval;
+    }
+    return pushmaster.push.jitter((push.poll_interval || 0) * 1000);
+};
+
+pushmaster.push.waitForPushData = function(delay) {
     if (push.state !== 'live' && !pushmaster.location.query.noreload) {
         pushmaster.push.retrieveTimeout = setTimeout(function() {
             pushmaster.push.retrieveTimeout = null;
+            // the server holds this until the push changes or it gives up with a 304
             pushmaster.xhr.get({
-                'url': location.pathname + '/json',
+                'url': location.pathname + '/wait',
+                'data': {'have': pushmaster.push.itemIds().join(',')},
+                'timeout': pushmaster.push.waitTimeout,
+                'beforeSend': function(xhr) {
+                    if (push.etag) {
+                        xhr.setRequestHeader('If-None-Match', push.etag);
+                    }
+                },
                 'success': pushmaster.push.loadPushData,
-                'error': pushmaster.push.retrievePushData});
-        }, pushmaster.push.pageReloadDelay);
+                'error': function() {
+                    pushmaster.push.waitForPushData(pushmaster.push.jitter(pushmaster.push.retryDelay));
+                    pushmaster.push.retryDelay = Math.min(2 * pushmaster.push.retryDelay, pushmaster.push.maxRetryDelay);
+                }});
+        }, delay || 0);
+    }
+};
+
+// ids of the request items on the page, which the server leaves out of its answers
+pushmaster.push.itemIds = function() {
+    return $('.push li.request[id]').map(function() { return this.id; }).get();
+};
+
+// an item the page already shows, moved out of its old list, or a new one
+pushmaster.push.renderItem = function(id, pushData) {
+    var item = document.getElementById(id);
+    return item ? $(item).detach() : $(pushData.rows[id]);
+};
+
+pushmaster.push.renderList = function(rows, className, pushData) {
+    var list = $('<ol/>').addClass(className);
+    $.each(rows, function(i, id) {
+        list.append(pushmaster.push.renderItem(id, pushData));
+    });
+    return list;
+};
+
+// rebuild the push div around its unchanged request items
+pushmaster.push.renderPush = function(pushData) {
+    var requests = $('<div class="requests"/>');
+    $.each(pushData.lists, function(i, list) {
+        if (list.label) {
+            requests.append($('<h3/>').text(list.label));
+        }
+        requests.append(pushmaster.push.renderList(list.rows, 'requests ' + list.state, pushData));
+    });
+    if (pushData.code) {
+        requests.append($('<div class="code"/>').text(pushData.code));
     }
+
+    var parts = [requests];
+    if (pushData.pending) {
+        parts.push($('<h2 class="pending"/>').text(pushData.pending.label));
+        parts.push(pushmaster.push.renderList(pushData.pending.rows, 'requests', pushData));
+    }
+
+    var pushDiv = $('.push').html(pushData.head);
+    $.each(parts, function(i, part) {
+        pushDiv.append(part);
+    });
 };
 
-pushmaster.push.loadPushData = function(pushData) {
-    push.state = pushData.push.state;
-    $('.push').html(pushData.html);
-    pushmaster.push.retrievePushData();
+pushmaster.push.loadPushData = function(pushData, textStatus, xhr) {
+    // 304 Not Modified: the page already shows this version
+    if (xhr.status !== 304 && pushData) {
+        push.state = pushData.push.state;
+        push.etag = xhr.getResponseHeader('ETag') || null;
+        pushmaster.push.renderPush(pushData);
+    }
+    pushmaster.push.retryDelay = pushmaster.push.minRetryDelay;
+    pushmaster.push.waitForPushData(pushmaster.push.pollDelay(xhr));
 };
 
 //
 // init
 //
 
-$(pushmaster.push.retrievePushData);
+$(function() {
+    pushmaster.push.waitForPushData(pushmaster.push.jitter((push.poll_interval || 0) * 1000));
+});